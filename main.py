@@ -1,4 +1,5 @@
 import os
+import sys
 import sqlite3
 import discord
 from discord.ext import commands, tasks
@@ -9,47 +10,755 @@ from typing import Optional
 import pytz
 import re
 import time
+import threading
+import atexit
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
 from google.api_core import exceptions as google_exceptions
 import asyncio
+import hashlib
+import unicodedata
+from collections import OrderedDict, deque
 # ========== Configuração ==========
 TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
-
-# Configuração do cliente de IA
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+
+# Roteamento por complexidade: mensagens simples vão para o modelo leve
+AI_MODEL_ROUTING = os.getenv("AI_MODEL_ROUTING", "true").lower() == "true"
+GEMINI_LIGHT_MODEL = os.getenv("GEMINI_LIGHT_MODEL", "gemini-2.5-flash-lite")
+OPENAI_LIGHT_MODEL = os.getenv("OPENAI_LIGHT_MODEL", OPENAI_MODEL)
+ROUTE_LIGHT_MAX_WORDS = int(os.getenv("ROUTE_LIGHT_MAX_WORDS", "12"))
+
+# Escritas de contabilidade (relacionamento, estatísticas, histórico) são gravadas em lote
+WRITE_BEHIND_FLUSH_MS = int(os.getenv("WRITE_BEHIND_FLUSH_MS", "500"))
+WRITE_BEHIND_MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", "50"))
+
+# Orçamento de uso da IA (free tier do Gemini: ~10 requisições/minuto)
+AI_REQUESTS_PER_MINUTE = int(os.getenv("AI_REQUESTS_PER_MINUTE", "10"))
+AI_TOKENS_PER_MINUTE = int(os.getenv("AI_TOKENS_PER_MINUTE", "250000"))
+AI_EXPECTED_OUTPUT_TOKENS = int(os.getenv("AI_EXPECTED_OUTPUT_TOKENS", "200"))
+
+# Orçamento de tokens do prompt (instrução de sistema + parte dinâmica)
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+PROMPT_MIN_CONTEXT_EXCHANGES = int(os.getenv("PROMPT_MIN_CONTEXT_EXCHANGES", "2"))
+
+# Cache de respostas para mensagens curtas e repetidas ("oi", "tudo bem?")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "500"))  # 0 desativa
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "1800"))
+RESPONSE_CACHE_VARIANTS = int(os.getenv("RESPONSE_CACHE_VARIANTS", "3"))
+RESPONSE_CACHE_MAX_WORDS = int(os.getenv("RESPONSE_CACHE_MAX_WORDS", "6"))
+
+# Limites do contexto de conversa em memória
+CONTEXT_MAX_EXCHANGES = int(os.getenv("CONTEXT_MAX_EXCHANGES", "10"))
+CONTEXT_IDLE_TTL_HOURS = float(os.getenv("CONTEXT_IDLE_TTL_HOURS", "6"))
+CONTEXT_MAX_CHANNELS = int(os.getenv("CONTEXT_MAX_CHANNELS", "2000"))
+CONTEXT_MAX_BYTES = int(os.getenv("CONTEXT_MAX_BYTES", str(8 * 1024 * 1024)))
+
+# Resumo contínuo: acima de CONTEXT_SUMMARY_THRESHOLD trocas, as antigas viram um resumo
+CONTEXT_SUMMARY_ENABLED = os.getenv("CONTEXT_SUMMARY_ENABLED", "true").lower() == "true"
+CONTEXT_SUMMARY_THRESHOLD = int(os.getenv("CONTEXT_SUMMARY_THRESHOLD", "6"))
+CONTEXT_KEEP_RECENT = int(os.getenv("CONTEXT_KEEP_RECENT", "3"))
+CONTEXT_SUMMARY_MAX_WORDS = int(os.getenv("CONTEXT_SUMMARY_MAX_WORDS", "120"))
+
+# Janela para agrupar mensagens seguidas no mesmo canal numa única resposta (0 desativa a espera)
+MESSAGE_COALESCE_WINDOW_MS = int(os.getenv("MESSAGE_COALESCE_WINDOW_MS", "1200"))
+
+# Bucket de envio por canal (o Discord aceita ~5 mensagens a cada 5 s por canal)
+OUTBOUND_CHANNEL_BURST = int(os.getenv("OUTBOUND_CHANNEL_BURST", "5"))
+OUTBOUND_CHANNEL_WINDOW_SECONDS = float(os.getenv("OUTBOUND_CHANNEL_WINDOW_SECONDS", "5"))
+
+# Envia cada frase completa enquanto o modelo ainda está gerando
+AI_STREAM_REPLIES = os.getenv("AI_STREAM_REPLIES", "false").lower() == "true"
+
+# Registra a parte fixa do prompt como cached content no Gemini (opcional)
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "false").lower() == "true"
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+GEMINI_CONTEXT_CACHE_RETRY_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_RETRY_SECONDS", "300"))  # dobra a cada falha seguida
+
+# Cadeia de provedores de IA, em ordem de preferência: "gemini", "openai" ou "stub" (respostas locais, sem rede)
+AI_PROVIDERS = [name.strip() for name in os.getenv("AI_PROVIDER", "gemini,openai").lower().split(",") if name.strip()]
+
+# Circuit breaker por provedor: falhas seguidas (cota/timeout) até desviar o tráfego e tempo de espera
+AI_BREAKER_FAILURE_THRESHOLD = int(os.getenv("AI_BREAKER_FAILURE_THRESHOLD", "3"))
+AI_BREAKER_COOLDOWN_SECONDS = float(os.getenv("AI_BREAKER_COOLDOWN_SECONDS", "60"))
+AI_MAX_ATTEMPTS = int(os.getenv("AI_MAX_ATTEMPTS", "3"))
+
+# Prazo de cada chamada ao provedor (segundos) e requisições de reserva ("hedging") no p90 de latência
+AI_REQUEST_TIMEOUT = float(os.getenv("AI_REQUEST_TIMEOUT", "30"))
+AI_HEDGE_REQUESTS = os.getenv("AI_HEDGE_REQUESTS", "false").lower() == "true"
+AI_HEDGE_BUDGET_PERCENT = float(os.getenv("AI_HEDGE_BUDGET_PERCENT", "10"))
+AI_HEDGE_MIN_SAMPLES = int(os.getenv("AI_HEDGE_MIN_SAMPLES", "20"))
+
+# Provedor stub para testes de carga: latência (ms), distribuição e injeção de falhas
+AI_STUB_LATENCY_MS = float(os.getenv("AI_STUB_LATENCY_MS", "800"))
+AI_STUB_LATENCY_JITTER_MS = float(os.getenv("AI_STUB_LATENCY_JITTER_MS", "300"))
+AI_STUB_LATENCY_DISTRIBUTION = os.getenv("AI_STUB_LATENCY_DISTRIBUTION", "normal").lower()  # fixed, uniform, normal, lognormal
+AI_STUB_RATE_LIMIT_RATE = float(os.getenv("AI_STUB_RATE_LIMIT_RATE", "0"))
+AI_STUB_TIMEOUT_RATE = float(os.getenv("AI_STUB_TIMEOUT_RATE", "0"))
+AI_STUB_TIMEOUT_SECONDS = float(os.getenv("AI_STUB_TIMEOUT_SECONDS", "30"))
+AI_STUB_SEED = os.getenv("AI_STUB_SEED")
+
+# Configuração dos clientes de IA
 ai_client = None
-ai_provider = None
+openai_client = None
 
-if GEMINI_API_KEY:
+if GEMINI_API_KEY and "gemini" in AI_PROVIDERS:
     try:
         from google import genai
+        from google.genai import types as genai_types
         ai_client = genai.Client(api_key=GEMINI_API_KEY)
-        ai_provider = "gemini"
         print("🤖 Usando Google Gemini (GRATUITO)")
     except ImportError:
         print("⚠️ google-genai não instalado.")
 
+if OPENAI_API_KEY and "openai" in AI_PROVIDERS:
+    try:
+        from openai import AsyncOpenAI
+        # Sem retries internos: quem tenta de novo (ou desvia de provedor) é a cadeia
+        openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0, timeout=30.0)
+        print(f"🤖 OpenAI disponível como fallback ({OPENAI_MODEL})")
+    except ImportError:
+        print("⚠️ openai não instalado.")
+
 # Configuração do bot (prefixo será dinâmico)
 intents = discord.Intents.default()
 intents.message_content = True
 
 # Função para obter prefixo dinâmico
 def get_prefix(bot, message):
-    return get_bot_config("prefix", "!")
+    return get_guild_config(message.guild, "prefix", "!")
 
-bot = commands.Bot(command_prefix=get_prefix, intents=intents)
+class AkutagawaBot(commands.Bot):
+    async def close(self):
+        """Grava as escritas pendentes antes de desconectar"""
+        await channel_outbox.stop()
+        await bookkeeping.stop()
+        await super().close()
+
+bot = AkutagawaBot(command_prefix=get_prefix, intents=intents)
 bot.remove_command("help")  # Remove comando help padrão para customizar
 
 # ========== Banco de Dados SQLite ==========
 DB_PATH = "memory.db"
 
-# Dicionário para armazenar contexto de conversa por canal
-conversation_context = {}
+class SQLiteStorage:
+    """
+    Camada de acesso ao SQLite usada por todos os helpers.
+    Mantém UMA conexão de escrita (serializada por lock) e uma conexão de leitura
+    por thread, todas persistentes e em modo WAL. Como as conexões vivem durante
+    todo o processo, o cache de statements do sqlite3 reaproveita as queries preparadas.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # Seguro com WAL, evita fsync a cada commit
+        conn.execute("PRAGMA cache_size=-8000")  # ~8 MB de cache de páginas
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _writer_conn(self) -> sqlite3.Connection:
+        if self._writer is None:
+            self._writer = self._connect()
+        return self._writer
+
+    def _reader_conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    def fetchone(self, sql: str, params: tuple = ()):
+        """Executa uma leitura e retorna a primeira linha (ou None)"""
+        cursor = self._reader_conn().execute(sql, params)
+        try:
+            return cursor.fetchone()
+        finally:
+            cursor.close()  # Finaliza o statement para não segurar o snapshot do WAL
+
+    def fetchall(self, sql: str, params: tuple = ()) -> list:
+        """Executa uma leitura e retorna todas as linhas"""
+        cursor = self._reader_conn().execute(sql, params)
+        try:
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    @contextmanager
+    def transaction(self):
+        """Abre uma transação na conexão de escrita (commit no fim, rollback em erro)"""
+        with self._write_lock:
+            conn = self._writer_conn()
+            cursor = conn.cursor()
+            try:
+                yield cursor
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def execute(self, sql: str, params: tuple = ()) -> int:
+        """Executa uma escrita em transação própria. Retorna o número de linhas afetadas"""
+        with self.transaction() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    def executemany(self, sql: str, seq_of_params) -> int:
+        """Executa a mesma escrita para vários parâmetros numa única transação"""
+        with self.transaction() as cursor:
+            cursor.executemany(sql, seq_of_params)
+            return cursor.rowcount
+
+    def close(self):
+        """Fecha todas as conexões abertas"""
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+        self._local = threading.local()
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+db = SQLiteStorage(DB_PATH)
+atexit.register(db.close)
+
+# Escala de 1 a 4000 interações dividida em 11 níveis (0-10)
+RELATIONSHIP_LEVEL_THRESHOLDS = [
+    (4000, 10), (3200, 9), (2400, 8), (1600, 7), (1000, 6),
+    (600, 5), (300, 4), (100, 3), (30, 2), (5, 1)
+]
+
+class WriteBehindBuffer:
+    """
+    Buffer de escrita para a contabilidade de cada mensagem.
+    Incrementos repetidos de relacionamento (por usuário) e de estatísticas (por data)
+    são somados em memória, e tudo é gravado numa única transação a cada
+    flush_interval segundos ou quando max_rows mutações se acumulam.
+    O contexto das conversas entra aqui como deltas (trocas novas, resumo, limpeza).
+    """
+
+    def __init__(self, storage: SQLiteStorage, flush_interval: float, max_rows: int):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self._relationships = {}  # user_id -> interações a somar
+        self._daily_messages = {}  # data -> mensagens a somar
+        self._interactions = []
+        self._context_exchanges = []  # (channel_id, seq, mensagem, resposta)
+        self._context_summaries = {}  # channel_id -> (resumo, seq da última troca resumida)
+        self._context_clears = set()
+        self._inflight = None  # Lote sendo gravado por flush() numa thread
+        self._pending = 0
+        self._wakeup = None
+        self._flush_lock = None
+        self._task = None
+        self._closed = False
+
+    def add_relationship(self, user_id: str):
+        self._relationships[user_id] = self._relationships.get(user_id, 0) + 1
+        self._mark_dirty()
+
+    def add_daily_message(self, date: str):
+        self._daily_messages[date] = self._daily_messages.get(date, 0) + 1
+        self._mark_dirty()
+
+    def add_interaction(self, user_id: str, channel_id: str, server_id: str, message: str, response: str):
+        self._interactions.append((user_id, channel_id, server_id, message, response))
+        self._mark_dirty()
+
+    def add_context_exchange(self, channel_id: str, seq: int, user_message: str, bot_response: str):
+        self._context_exchanges.append((channel_id, seq, user_message, bot_response))
+        self._mark_dirty()
+
+    def set_context_summary(self, channel_id: str, summary: str, folded_through: int):
+        self._context_summaries[channel_id] = (summary, folded_through)
+        self._mark_dirty()
+
+    def clear_context(self, channel_id: str):
+        # Trocas ainda não gravadas deste canal não precisam mais ir para o banco
+        self._context_exchanges = [row for row in self._context_exchanges if row[0] != channel_id]
+        self._context_summaries.pop(channel_id, None)
+        self._context_clears.add(channel_id)
+        self._mark_dirty()
+
+    def pending_context(self, channel_id: str):
+        """
+        Deltas de contexto do canal ainda não gravados (lote em gravação e buffer):
+        (limpo?, [(seq, mensagem, resposta)], (resumo, folded_through) ou None)
+        """
+        cleared, exchanges, summary = False, [], None
+        batches = [self._inflight[3:]] if self._inflight else []
+        batches.append((self._context_clears, self._context_exchanges, self._context_summaries))
+        for context_clears, context_exchanges, context_summaries in batches:
+            # Num lote a limpeza vem antes das trocas e do resumo (ver _write_batch)
+            if channel_id in context_clears:
+                cleared, exchanges, summary = True, [], None
+            exchanges += [(seq, user, bot) for row_channel, seq, user, bot in context_exchanges if row_channel == channel_id]
+            summary = context_summaries.get(channel_id, summary)
+        return cleared, exchanges, summary
+
+    async def run_read(self, read, *args):
+        """
+        Executa uma leitura numa thread sem cruzar com um flush: o que ela não
+        encontrar no banco ainda está em pending_context quando ela termina.
+        """
+        if self._flush_lock is None:
+            return await asyncio.to_thread(read, *args)
+        async with self._flush_lock:
+            return await asyncio.to_thread(read, *args)
+
+    def _mark_dirty(self):
+        self._pending += 1
+        if self._closed:
+            self.flush_sync()
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Fora do event loop (ex: desligamento) grava direto
+            self.flush_sync()
+            return
+
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+
+        if self._pending >= self.max_rows:
+            self._wakeup.set()
+
+    def _take_batch(self):
+        batch = (
+            self._relationships, self._daily_messages, self._interactions,
+            self._context_clears, self._context_exchanges, self._context_summaries
+        )
+        self._relationships, self._daily_messages, self._interactions = {}, {}, []
+        self._context_clears, self._context_exchanges, self._context_summaries = set(), [], {}
+        self._pending = 0
+        return batch
+
+    def _restore_batch(self, batch):
+        """Devolve ao buffer um lote que falhou, para nova tentativa no próximo flush"""
+        relationships, daily_messages, interactions, context_clears, context_exchanges, context_summaries = batch
+        for user_id, count in relationships.items():
+            self._relationships[user_id] = self._relationships.get(user_id, 0) + count
+        for date, count in daily_messages.items():
+            self._daily_messages[date] = self._daily_messages.get(date, 0) + count
+        self._interactions = interactions + self._interactions
+        # Limpezas feitas depois do lote falho descartam as trocas antigas daquele canal
+        self._context_exchanges = [
+            row for row in context_exchanges if row[0] not in self._context_clears
+        ] + self._context_exchanges
+        for channel_id, summary in context_summaries.items():
+            if channel_id not in self._context_clears:
+                self._context_summaries.setdefault(channel_id, summary)
+        self._context_clears |= context_clears
+        self._pending += (
+            len(relationships) + len(daily_messages) + len(interactions)
+            + len(context_clears) + len(context_exchanges) + len(context_summaries)
+        )
+
+    def _write_batch(self, batch):
+        relationships, daily_messages, interactions, context_clears, context_exchanges, context_summaries = batch
+        with self.storage.transaction() as cursor:
+            if relationships:
+                cursor.executemany("""
+                    INSERT INTO relationships (user_id, interactions, level) 
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(user_id) 
+                    DO UPDATE SET 
+                        interactions = interactions + excluded.interactions,
+                        level = CASE 
+                            WHEN interactions + excluded.interactions >= 4000 THEN 10
+                            WHEN interactions + excluded.interactions >= 3200 THEN 9
+                            WHEN interactions + excluded.interactions >= 2400 THEN 8
+                            WHEN interactions + excluded.interactions >= 1600 THEN 7
+                            WHEN interactions + excluded.interactions >= 1000 THEN 6
+                            WHEN interactions + excluded.interactions >= 600 THEN 5
+                            WHEN interactions + excluded.interactions >= 300 THEN 4
+                            WHEN interactions + excluded.interactions >= 100 THEN 3
+                            WHEN interactions + excluded.interactions >= 30 THEN 2
+                            WHEN interactions + excluded.interactions >= 5 THEN 1
+                            ELSE 0
+                        END,
+                        last_interaction = CURRENT_TIMESTAMP
+                """, [(user_id, count, get_relationship_level(count)) for user_id, count in relationships.items()])
+
+            if daily_messages:
+                cursor.executemany("""
+                    INSERT INTO stats (date, messages_sent) 
+                    VALUES (?, ?)
+                    ON CONFLICT(date) 
+                    DO UPDATE SET messages_sent = messages_sent + excluded.messages_sent
+                """, list(daily_messages.items()))
+
+            if interactions:
+                cursor.executemany("""
+                    INSERT INTO interaction_history (user_id, channel_id, server_id, message_content, bot_response)
+                    VALUES (?, ?, ?, ?, ?)
+                """, interactions)
+
+            if context_clears:
+                cleared = [(channel_id,) for channel_id in context_clears]
+                cursor.executemany("DELETE FROM conversation_log WHERE channel_id = ?", cleared)
+                cursor.executemany("DELETE FROM conversation_summary WHERE channel_id = ?", cleared)
+
+            if context_exchanges:
+                cursor.executemany("""
+                    INSERT OR REPLACE INTO conversation_log (channel_id, seq, user_message, bot_response)
+                    VALUES (?, ?, ?, ?)
+                """, context_exchanges)
+
+            if context_summaries:
+                cursor.executemany("""
+                    INSERT INTO conversation_summary (channel_id, summary, folded_through)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(channel_id)
+                    DO UPDATE SET summary = excluded.summary, folded_through = excluded.folded_through, updated_at = CURRENT_TIMESTAMP
+                """, [(channel_id, summary, folded_through) for channel_id, (summary, folded_through) in context_summaries.items()])
+
+            # O log só guarda as trocas que ainda não viraram resumo e cabem na memória
+            touched = {row[0] for row in context_exchanges} | set(context_summaries)
+            if touched:
+                cursor.executemany("""
+                    DELETE FROM conversation_log
+                    WHERE channel_id = ?
+                      AND (seq <= (SELECT MAX(seq) FROM conversation_log WHERE channel_id = ?) - ?
+                           OR seq <= COALESCE((SELECT folded_through FROM conversation_summary WHERE channel_id = ?), -1))
+                """, [(channel_id, channel_id, CONTEXT_MAX_EXCHANGES, channel_id) for channel_id in touched])
+
+    async def flush(self):
+        """Grava tudo que está pendente numa única transação, fora do event loop"""
+        if not self._pending:
+            return
+        async with self._flush_lock:
+            batch = self._take_batch()
+            self._inflight = batch
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            except Exception as e:
+                print(f"❌ Erro ao gravar lote de escritas: {e}")
+                traceback.print_exc()
+                self._restore_batch(batch)
+            finally:
+                self._inflight = None
+
+    def flush_sync(self):
+        """Grava o que está pendente de forma síncrona (usado no desligamento)"""
+        if not self._pending:
+            return
+        batch = self._take_batch()
+        try:
+            self._write_batch(batch)
+        except Exception as e:
+            print(f"❌ Erro ao gravar lote de escritas: {e}")
+            self._restore_batch(batch)
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def stop(self):
+        """Para o worker e garante o flush final"""
+        self._closed = True
+        if self._task and not self._task.done():
+            self._wakeup.set()
+            try:
+                await self._task
+            except Exception:
+                traceback.print_exc()
+        if self._flush_lock is not None:
+            await self.flush()
+        else:
+            self.flush_sync()
+
+bookkeeping = WriteBehindBuffer(db, WRITE_BEHIND_FLUSH_MS / 1000, WRITE_BEHIND_MAX_ROWS)
+atexit.register(bookkeeping.flush_sync)
+
+class ConversationStore:
+    """
+    Contexto de conversa por canal com memória limitada: cada canal guarda no máximo
+    `max_exchanges` trocas (deque) e um resumo; canais parados há mais de `idle_ttl`
+    segundos são descartados e, acima de `max_channels` canais ou `max_bytes` de texto,
+    os menos recentes saem primeiro (OrderedDict em ordem de atividade).
+    Cada mudança vira um delta no `writer` (write-behind); um canal que não está em
+    memória é recarregado do banco só quando é acessado de novo e só se há algo
+    gravado dele (`_persisted`). O caminho de resposta chama load() antes, para que
+    essa leitura rode numa thread; o que ainda não foi gravado vem do `writer`.
+    """
+
+    def __init__(self, max_exchanges: int, idle_ttl: float, max_channels: int, max_bytes: int,
+                 storage: Optional[SQLiteStorage] = None, writer: Optional[WriteBehindBuffer] = None):
+        self.max_exchanges = max_exchanges
+        self.storage = storage
+        self.writer = writer
+        self.idle_ttl = idle_ttl
+        self.max_channels = max_channels
+        self.max_bytes = max_bytes
+        self._channels = OrderedDict()  # channel_id -> {"exchanges", "summary", "last_active", "bytes"}
+        self._persisted = set()  # Canais com trocas ou resumo no banco (ou a caminho dele)
+        self.total_bytes = 0
+        self.evicted_idle = 0
+        self.evicted_capacity = 0
+        self.rehydrated = 0
+
+    def __contains__(self, channel_id: str) -> bool:
+        return channel_id in self._channels
+
+    def _new_entry(self, exchanges=(), summary: str = "", last_seq: int = 0) -> dict:
+        return {
+            "exchanges": deque(exchanges, maxlen=self.max_exchanges),
+            "summary": summary,
+            "last_active": time.monotonic(),
+            "bytes": 0,
+            "last_seq": last_seq
+        }
+
+    def load_index(self):
+        """Lê quais canais têm contexto gravado (chamado uma vez na inicialização)"""
+        if self.storage is None:
+            return
+        rows = self.storage.fetchall("""
+            SELECT channel_id FROM conversation_log
+            UNION SELECT channel_id FROM conversation_summary
+        """)
+        self._persisted = {channel_id for (channel_id,) in rows}
+
+    def _read_stored(self, channel_id: str):
+        """Lê do banco o resumo e as trocas ainda não resumidas do canal"""
+        row = self.storage.fetchone(
+            "SELECT summary, folded_through FROM conversation_summary WHERE channel_id = ?", (channel_id,)
+        )
+        summary, folded_through = row if row else ("", -1)
+        rows = self.storage.fetchall("""
+            SELECT seq, user_message, bot_response FROM conversation_log
+            WHERE channel_id = ? AND seq > ?
+            ORDER BY seq DESC LIMIT ?
+        """, (channel_id, folded_through, self.max_exchanges))
+        return summary, folded_through, rows
+
+    def _rehydrate(self, channel_id: str, stored) -> dict:
+        """Monta a entrada do canal com o que foi lido do banco mais os deltas ainda não gravados"""
+        summary, folded_through, rows = stored
+        cleared, pending_exchanges, pending_summary = (
+            self.writer.pending_context(channel_id) if self.writer is not None else (False, [], None)
+        )
+        if cleared:
+            summary, folded_through, rows = "", -1, []
+        if pending_summary:
+            summary, folded_through = pending_summary
+
+        by_seq = {seq: (user, bot) for seq, user, bot in rows}
+        by_seq.update((seq, (user, bot)) for seq, user, bot in pending_exchanges)
+        seqs = sorted(seq for seq in by_seq if seq > folded_through)[-self.max_exchanges:]
+        exchanges = [{"user": by_seq[seq][0], "bot": by_seq[seq][1], "seq": seq} for seq in seqs]
+        # A próxima troca continua depois de tudo que já existe, gravado ou não
+        last_seq = max([folded_through, 0, *by_seq])
+
+        entry = self._new_entry(exchanges, summary, last_seq)
+        if exchanges or summary:
+            self.rehydrated += 1
+            print(f"♻️ Contexto do canal {channel_id} recarregado do banco ({len(exchanges)} trocas{', com resumo' if summary else ''})")
+        self._channels[channel_id] = entry
+        self._resize(channel_id)
+        self.evict()
+        return entry
+
+    async def load(self, channel_id: str):
+        """Traz o canal para a memória lendo o banco numa thread (nada a fazer se já está ou não há o que ler)"""
+        if self.storage is None or channel_id in self._channels or channel_id not in self._persisted:
+            return
+        if self.writer is not None:
+            stored = await self.writer.run_read(self._read_stored, channel_id)
+        else:
+            stored = await asyncio.to_thread(self._read_stored, channel_id)
+        # Um acesso síncrono pode ter carregado o canal enquanto isso
+        if channel_id not in self._channels:
+            self._rehydrate(channel_id, stored)
+
+    def _get(self, channel_id: str) -> Optional[dict]:
+        """Entrada do canal, ou None se não há nada dele em memória nem no banco"""
+        entry = self._channels.get(channel_id)
+        if entry is None and self.storage is not None and channel_id in self._persisted:
+            # Sem load() antes, a leitura acontece aqui mesmo
+            entry = self._rehydrate(channel_id, self._read_stored(channel_id))
+        return entry
+
+    @staticmethod
+    def _size(entry: dict) -> int:
+        size = len(entry["summary"].encode("utf-8"))
+        for exchange in entry["exchanges"]:
+            size += len(exchange["user"].encode("utf-8")) + len(exchange["bot"].encode("utf-8"))
+        return size
+
+    def _resize(self, channel_id: str):
+        entry = self._channels[channel_id]
+        new_size = self._size(entry)
+        self.total_bytes += new_size - entry["bytes"]
+        entry["bytes"] = new_size
+
+    def _touch(self, channel_id: str) -> dict:
+        entry = self._get(channel_id)
+        if entry is None:
+            entry = self._new_entry()
+            self._channels[channel_id] = entry
+        entry["last_active"] = time.monotonic()
+        self._channels.move_to_end(channel_id)
+        return entry
+
+    def _drop(self, channel_id: str):
+        entry = self._channels.pop(channel_id)
+        self.total_bytes -= entry["bytes"]
+
+    def evict(self):
+        """Remove canais inativos e, se preciso, os menos recentes até caber nos limites"""
+        idle_before = time.monotonic() - self.idle_ttl
+        while self._channels:
+            channel_id, entry = next(iter(self._channels.items()))
+            if entry["last_active"] < idle_before:
+                self._drop(channel_id)
+                self.evicted_idle += 1
+            elif len(self._channels) > self.max_channels or self.total_bytes > self.max_bytes:
+                if len(self._channels) == 1:
+                    break  # Nunca descarta o canal que acabou de falar
+                self._drop(channel_id)
+                self.evicted_capacity += 1
+            else:
+                break
+
+    def append(self, channel_id: str, exchange: dict):
+        entry = self._touch(channel_id)
+        entry["last_seq"] += 1
+        exchange["seq"] = entry["last_seq"]
+        entry["exchanges"].append(exchange)
+        self._resize(channel_id)
+        self._persisted.add(channel_id)
+        if self.writer is not None:
+            self.writer.add_context_exchange(channel_id, exchange["seq"], exchange["user"], exchange["bot"])
+        self.evict()
+
+    def exchanges(self, channel_id: str) -> list:
+        entry = self._get(channel_id)
+        return list(entry["exchanges"]) if entry else []
+
+    def depth(self, channel_id: str) -> int:
+        entry = self._get(channel_id)
+        return len(entry["exchanges"]) if entry else 0
+
+    def summary(self, channel_id: str) -> str:
+        entry = self._get(channel_id)
+        return entry["summary"] if entry else ""
+
+    def fold(self, channel_id: str, folded: list, summary: str) -> bool:
+        """Troca as trocas `folded` pelo resumo. False se o canal foi limpo/descartado nesse meio tempo"""
+        entry = self._channels.get(channel_id)
+        if not entry or not folded or not any(exchange is folded[-1] for exchange in entry["exchanges"]):
+            return False
+        remaining = [exchange for exchange in entry["exchanges"] if all(exchange is not old for old in folded)]
+        entry["exchanges"] = deque(remaining, maxlen=self.max_exchanges)
+        entry["summary"] = summary
+        self._resize(channel_id)
+        if self.writer is not None:
+            self.writer.set_context_summary(channel_id, summary, folded[-1]["seq"])
+        return True
+
+    def clear(self, channel_id: str) -> bool:
+        """Esquece o contexto do canal (memória e banco). Retorna se havia algo para limpar"""
+        entry = self._get(channel_id)
+        if entry is None:
+            return False
+        had_context = bool(entry["exchanges"] or entry["summary"])
+        self._drop(channel_id)
+        self._channels[channel_id] = self._new_entry(last_seq=entry["last_seq"])
+        self._persisted.discard(channel_id)
+        if self.writer is not None:
+            self.writer.clear_context(channel_id)
+        return had_context
+
+    def stats(self) -> dict:
+        return {
+            "rehydrated": self.rehydrated,
+            "channels": len(self._channels),
+            "exchanges": sum(len(entry["exchanges"]) for entry in self._channels.values()),
+            "bytes": self.total_bytes,
+            "evicted_idle": self.evicted_idle,
+            "evicted_capacity": self.evicted_capacity
+        }
+
+# Contexto de conversa por canal (limitado)
+conversation_store = ConversationStore(
+    CONTEXT_MAX_EXCHANGES,
+    CONTEXT_IDLE_TTL_HOURS * 3600,
+    CONTEXT_MAX_CHANNELS,
+    CONTEXT_MAX_BYTES,
+    storage=db,
+    writer=bookkeeping
+)
+
+# Cache em memória da tabela bot_config (None até ser carregado)
+bot_config_cache = None
+
+# Valores padrão de bot_config (também usados pelo !resetconfig)
+DEFAULT_BOT_CONFIG = {
+    "prefix": "!",
+    "tone": "neutro",
+    "default_channel": "",
+    "avatar_url": "",
+    "bot_name": "Akutagawa",
+    "memory_duration": "longo",
+    "continuous_learning": "true",
+    "current_mood": "neutro",
+    "respond_all_channels": "false"
+}
+
+# Chaves que cada servidor pode sobrescrever; as demais valem para o bot inteiro
+GUILD_CONFIG_KEYS = ("prefix", "default_channel", "respond_all_channels", "tone", "current_mood")
+
+# Cache em memória da tabela guild_config: guild_id -> {chave: valor} (None até ser carregado)
+guild_config_cache = None
+
+# Canais bloqueados em memória: server_id -> frozenset de channel_ids (None até ser carregado)
+blocked_channels_cache = None
+
+# Cache em memória da personalidade (None até ser lido)
+personality_cache = None
 
 def init_db():
     """Inicializa o banco de dados"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    with db.transaction() as cursor:
+        _create_schema(cursor)
+    load_bot_config_cache()
+    load_guild_config_cache()
+    load_blocked_channels_cache()
+    dalua_index.load()
+    conversation_store.load_index()
+
+def _create_schema(cursor):
+    """Cria as tabelas e insere os dados padrão"""
 
     # Tabela de fatos/memórias
     cursor.execute("""
@@ -81,6 +790,17 @@ def init_db():
         )
     """)
 
+    # Configurações por servidor (sobrescrevem as globais em GUILD_CONFIG_KEYS)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS guild_config (
+            guild_id TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (guild_id, key)
+        )
+    """)
+
     # Tabela de canais bloqueados
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS blocked_channels (
@@ -113,6 +833,26 @@ def init_db():
         )
     """)
 
+    # Contexto de conversa persistido (trocas recentes e resumo por canal)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_log (
+            channel_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            user_message TEXT NOT NULL,
+            bot_response TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (channel_id, seq)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_summary (
+            channel_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            folded_through INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
     # Tabela de estatísticas
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS stats (
@@ -141,19 +881,7 @@ Nunca use asteriscos ou ações narrativas."""
         cursor.execute("INSERT INTO personality (id, text) VALUES (1, ?)", (default_personality,))
 
     # Insere configurações padrão se não existirem
-    default_configs = {
-        "prefix": "!",
-        "tone": "neutro",
-        "default_channel": "",
-        "avatar_url": "",
-        "bot_name": "Akutagawa",
-        "memory_duration": "longo",
-        "continuous_learning": "true",
-        "current_mood": "neutro",
-        "respond_all_channels": "false"
-    }
-
-    for key, value in default_configs.items():
+    for key, value in DEFAULT_BOT_CONFIG.items():
         cursor.execute("INSERT OR IGNORE INTO bot_config (key, value) VALUES (?, ?)", (key, value))
 
     # Adiciona informações da Dalua se ainda não existirem
@@ -170,231 +898,341 @@ Nunca use asteriscos ou ações narrativas."""
         ]
         cursor.executemany("INSERT INTO facts (user_id, key, value) VALUES (?, ?, ?)", dalua_facts)
 
-    conn.commit()
-    conn.close()
+def load_bot_config_cache():
+    """Carrega a tabela bot_config inteira para o cache em memória"""
+    global bot_config_cache
+    bot_config_cache = dict(db.fetchall("SELECT key, value FROM bot_config"))
 
 def get_bot_config(key: str, default: str = "") -> str:
-    """Retorna uma configuração global do bot"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT value FROM bot_config WHERE key = ?", (key,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else default
+    """Retorna uma configuração global do bot (lida do cache em memória)"""
+    if bot_config_cache is None:
+        load_bot_config_cache()
+    return bot_config_cache.get(key, default)
 
 def set_bot_config(key: str, value: str):
     """Define uma configuração global do bot"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
+    set_bot_configs({key: value})
+
+def set_bot_configs(values: dict):
+    """Define várias configurações globais numa única transação e atualiza o cache"""
+    global bot_config_cache
+    db.executemany("""
         INSERT INTO bot_config (key, value) 
         VALUES (?, ?)
         ON CONFLICT(key) 
         DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
-    """, (key, value))
-    conn.commit()
-    conn.close()
+    """, list(values.items()))
+
+    # Só troca o cache depois do commit, e de uma vez (leitores nunca veem estado parcial)
+    if bot_config_cache is None:
+        load_bot_config_cache()
+    else:
+        bot_config_cache = {**bot_config_cache, **values}
+
+def load_guild_config_cache():
+    """Carrega a tabela guild_config inteira para o cache em memória"""
+    global guild_config_cache
+    cache = {}
+    for guild_id, key, value in db.fetchall("SELECT guild_id, key, value FROM guild_config"):
+        cache.setdefault(guild_id, {})[key] = value
+    guild_config_cache = cache
+
+def get_guild_config(guild, key: str, default: str = "") -> str:
+    """
+    Configuração efetiva num servidor: o valor próprio do servidor, se houver,
+    senão o global. Sem servidor (DM) ou para chaves globais, lê só o global.
+    """
+    if guild is not None and key in GUILD_CONFIG_KEYS:
+        if guild_config_cache is None:
+            load_guild_config_cache()
+        overrides = guild_config_cache.get(str(guild.id))
+        if overrides and key in overrides:
+            return overrides[key]
+    return get_bot_config(key, default)
+
+def set_guild_config(guild, key: str, value: str):
+    """Define uma configuração no escopo do servidor (ou global, em DM)"""
+    set_guild_configs(guild, {key: value})
+
+def set_guild_configs(guild, values: dict):
+    """Define várias configurações do servidor numa única transação e atualiza o cache"""
+    global guild_config_cache
+    guild_values = {key: value for key, value in values.items() if key in GUILD_CONFIG_KEYS}
+    global_values = {key: value for key, value in values.items() if key not in guild_values}
+    if guild is None:
+        global_values.update(guild_values)
+        guild_values = {}
+
+    if global_values:
+        set_bot_configs(global_values)
+    if not guild_values:
+        return
+
+    guild_id = str(guild.id)
+    db.executemany("""
+        INSERT INTO guild_config (guild_id, key, value)
+        VALUES (?, ?, ?)
+        ON CONFLICT(guild_id, key)
+        DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+    """, [(guild_id, key, value) for key, value in guild_values.items()])
+
+    if guild_config_cache is None:
+        load_guild_config_cache()
+    else:
+        guild_config_cache = {**guild_config_cache, guild_id: {**guild_config_cache.get(guild_id, {}), **guild_values}}
+
+def get_guild_default_channel(guild):
+    """Canal padrão do servidor, se estiver configurado e pertencer a ele"""
+    channel_id = get_guild_config(guild, "default_channel")
+    if not channel_id or guild is None:
+        return None
+    return guild.get_channel(int(channel_id))
 
 def add_or_update_fact(user_id: str, key: str, value: str):
     """Adiciona ou atualiza um fato"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
+    db.execute("""
         INSERT INTO facts (user_id, key, value) 
         VALUES (?, ?, ?)
         ON CONFLICT(user_id, key) 
         DO UPDATE SET value = excluded.value, created_at = CURRENT_TIMESTAMP
     """, (user_id, key, value))
-    conn.commit()
-    conn.close()
+    dalua_index.record_fact(user_id, key, value)
+
+def add_or_update_facts(user_id: str, facts: dict):
+    """Adiciona ou atualiza vários fatos de um usuário de uma vez"""
+    db.executemany("""
+        INSERT INTO facts (user_id, key, value) 
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id, key) 
+        DO UPDATE SET value = excluded.value, created_at = CURRENT_TIMESTAMP
+    """, [(user_id, key, value) for key, value in facts.items()])
+    for key, value in facts.items():
+        dalua_index.record_fact(user_id, key, value)
 
 def delete_fact(user_id: str, key: str) -> bool:
     """Remove um fato. Retorna True se removeu algo"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM facts WHERE user_id = ? AND key = ?", (user_id, key))
-    deleted = cursor.rowcount > 0
-    conn.commit()
-    conn.close()
-    return deleted
+    removed = db.execute("DELETE FROM facts WHERE user_id = ? AND key = ?", (user_id, key)) > 0
+    if removed:
+        dalua_index.forget(user_id, key)
+    return removed
+
+def delete_user_facts(user_id: str) -> int:
+    """Remove todos os fatos de um usuário. Retorna quantos foram removidos"""
+    deleted_count = db.execute("DELETE FROM facts WHERE user_id = ?", (user_id,))
+    dalua_index.forget(user_id)
+    return deleted_count
 
 def get_user_facts(user_id: str):
     """Retorna todos os fatos de um usuário"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT key, value FROM facts WHERE user_id = ? ORDER BY created_at DESC", (user_id,))
-    facts = cursor.fetchall()
-    conn.close()
-    return facts
+    return db.fetchall("SELECT key, value FROM facts WHERE user_id = ? ORDER BY created_at DESC", (user_id,))
 
 def set_personality(text: str):
     """Define a personalidade global do bot"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE personality SET text = ?, updated_at = CURRENT_TIMESTAMP WHERE id = 1", (text,))
-    conn.commit()
-    conn.close()
+    global personality_cache
+    db.execute("UPDATE personality SET text = ?, updated_at = CURRENT_TIMESTAMP WHERE id = 1", (text,))
+    personality_cache = text
 
 def get_personality() -> str:
-    """Retorna a personalidade atual"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT text FROM personality WHERE id = 1")
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else "Você é Ryūnosuke Akutagawa de Bungou Stray Dogs."
+    """Retorna a personalidade atual (cacheada em memória)"""
+    global personality_cache
+    if personality_cache is None:
+        result = db.fetchone("SELECT text FROM personality WHERE id = 1")
+        personality_cache = result[0] if result else "Você é Ryūnosuke Akutagawa de Bungou Stray Dogs."
+    return personality_cache
 
 def add_to_conversation_context(channel_id: str, user_message: str, bot_response: str):
-    """Adiciona mensagem ao contexto da conversa (mantém últimas 10 mensagens)"""
-    if channel_id not in conversation_context:
-        conversation_context[channel_id] = []
-
-    conversation_context[channel_id].append({
+    """Adiciona mensagem ao contexto da conversa (mantém as últimas CONTEXT_MAX_EXCHANGES trocas)"""
+    conversation_store.append(channel_id, {
         "user": user_message,
         "bot": bot_response
     })
 
-    # Mantém apenas as últimas 10 trocas de mensagens
-    if len(conversation_context[channel_id]) > 10:
-        conversation_context[channel_id] = conversation_context[channel_id][-10:]
+    # Trocas antigas são resumidas em segundo plano, fora do caminho da resposta
+    conversation_summarizer.maybe_schedule(channel_id)
 
-def get_conversation_context(channel_id: str) -> str:
-    """Retorna o contexto da conversa atual formatado"""
-    if channel_id not in conversation_context or not conversation_context[channel_id]:
+def get_conversation_exchanges(channel_id: str) -> list:
+    """Retorna uma cópia das trocas de mensagens do canal (mais antigas primeiro)"""
+    return conversation_store.exchanges(channel_id)
+
+def format_conversation_context(exchanges: list, summary: str = "") -> str:
+    """Formata o resumo e a lista de trocas como contexto para o prompt"""
+    if not exchanges and not summary:
         return ""
 
-    context = "\n\nCONTEXTO DA CONVERSA ATUAL (últimas mensagens):\n"
-    for exchange in conversation_context[channel_id]:
+    context = ""
+    if summary:
+        context += f"\n\nRESUMO DO INÍCIO DESTA CONVERSA:\n{summary}\n"
+    if exchanges:
+        context += "\n\nCONTEXTO DA CONVERSA ATUAL (últimas mensagens):\n"
+    for exchange in exchanges:
         context += f"Usuário: {exchange['user']}\n"
         context += f"Você respondeu: {exchange['bot']}\n"
 
     context += "\nIMPORTANTE: Mantenha COERÊNCIA com o que você disse acima. Se mencionou estar lendo um livro, continue com o MESMO livro. Não mude informações no meio da conversa!\n"
     return context
 
-def auto_learn_personal_info(user_id: str, message: str):
-    """Detecta e salva automaticamente informações pessoais importantes"""
-    message_lower = message.lower()
-
-    # Padrões de detecção de informações pessoais
-    patterns = {
-        # Idade
-        r'tenho (\d+) anos?': lambda m: ('idade', f"{m.group(1)} anos"),
-        r'(?:minha idade é|eu tenho) (\d+)': lambda m: ('idade', f"{m.group(1)} anos"),
-
-        # Data de nascimento
-        r'nasci (?:em|no dia) (\d{1,2})\s*(?:de|/)\s*(\w+)\s*(?:de|/)?\s*(\d{4})': 
-            lambda m: ('data_nascimento', f"{m.group(1)} de {m.group(2)} de {m.group(3)}"),
-        r'aniversário.*?(\d{1,2})\s*(?:de|/)\s*(\w+)': 
-            lambda m: ('aniversário', f"{m.group(1)} de {m.group(2)}"),
-
-        # Comida favorita
-        r'(?:minha comida favorita é|gosto de comer|amo) (?:a |o )?(\w+)': 
-            lambda m: ('comida_favorita', m.group(1)),
-
-        # Jogo favorito
-        r'(?:meu jogo favorito é|jogo muito|gosto de jogar) (\w[\w\s]+?)(?:\.|,|$)': 
-            lambda m: ('jogo_favorito', m.group(1).strip()),
-
-        # Anime favorito
-        r'(?:meu anime favorito é|assisto|gosto de) (\w[\w\s]+?)(?:\.|,|$)': 
-            lambda m: ('anime_favorito', m.group(1).strip()),
-
-        # Música/Artista favorito
-        r'(?:minha música favorita é|escuto muito|gosto de ouvir) (\w[\w\s]+?)(?:\.|,|$)': 
-            lambda m: ('musica_favorita', m.group(1).strip()),
-        r'(?:meu artista favorito é|ouço muito) (\w[\w\s]+?)(?:\.|,|$)': 
-            lambda m: ('artista_favorito', m.group(1).strip()),
-
-        # Nome
-        r'(?:meu nome é|me chamo|pode me chamar de) (\w+)': 
-            lambda m: ('nome', m.group(1)),
-
-        # Cor favorita
-        r'(?:minha cor favorita é|gosto (?:da cor|do)) (\w+)': 
-            lambda m: ('cor_favorita', m.group(1)),
-    }
+def get_conversation_context(channel_id: str) -> str:
+    """Retorna o contexto da conversa atual formatado"""
+    return format_conversation_context(get_conversation_exchanges(channel_id), conversation_store.summary(channel_id))
+
+# Padrões de detecção de informações pessoais: (chave, regex, formatação dos grupos, palavras-gatilho)
+AUTO_LEARN_RULES = [
+    # Idade
+    ("idade", r'tenho (\d+) anos?', lambda g: f"{g[0]} anos", ["tenho"]),
+    ("idade", r'(?:minha idade é|eu tenho) (\d+)', lambda g: f"{g[0]} anos", ["idade", "tenho"]),
+
+    # Data de nascimento
+    ("data_nascimento", r'nasci (?:em|no dia) (\d{1,2})\s*(?:de|/)\s*(\w+)\s*(?:de|/)?\s*(\d{4})',
+        lambda g: f"{g[0]} de {g[1]} de {g[2]}", ["nasci"]),
+    ("aniversário", r'aniversário.*?(\d{1,2})\s*(?:de|/)\s*(\w+)', lambda g: f"{g[0]} de {g[1]}", ["aniversário"]),
+
+    # Comida favorita
+    ("comida_favorita", r'(?:minha comida favorita é|gosto de comer|amo) (?:a |o )?(\w+)', lambda g: g[0], ["comida", "comer", "amo "]),
+
+    # Jogo favorito
+    ("jogo_favorito", r'(?:meu jogo favorito é|jogo muito|gosto de jogar) (\w[\w\s]+?)(?:\.|,|$)', lambda g: g[0].strip(), ["jogo", "jogar"]),
+
+    # Anime favorito
+    ("anime_favorito", r'(?:meu anime favorito é|assisto|gosto de) (\w[\w\s]+?)(?:\.|,|$)', lambda g: g[0].strip(), ["anime", "assisto", "gosto de"]),
+
+    # Música/Artista favorito
+    ("musica_favorita", r'(?:minha música favorita é|escuto muito|gosto de ouvir) (\w[\w\s]+?)(?:\.|,|$)', lambda g: g[0].strip(), ["música", "escuto", "ouvir"]),
+    ("artista_favorito", r'(?:meu artista favorito é|ouço muito) (\w[\w\s]+?)(?:\.|,|$)', lambda g: g[0].strip(), ["artista", "ouço"]),
 
-    # Procura por padrões e salva automaticamente
-    for pattern, extractor in patterns.items():
-        match = re.search(pattern, message_lower)
-        if match:
+    # Nome
+    ("nome", r'(?:meu nome é|me chamo|pode me chamar de) (\w+)', lambda g: g[0], ["nome", "chamo", "chamar"]),
+
+    # Cor favorita
+    ("cor_favorita", r'(?:minha cor favorita é|gosto (?:da cor|do)) (\w+)', lambda g: g[0], ["cor", "gosto do"]),
+]
+
+class FactExtractor:
+    """
+    Extrator de fatos pessoais compilado uma única vez. Um filtro com todas as
+    palavras-gatilho descarta as mensagens que nenhuma regra pode casar; nas demais,
+    só as regras cujos gatilhos aparecem na mensagem rodam sua própria regex
+    pré-compilada. As regras são independentes (um trecho pode servir a várias) e,
+    se duas regras da mesma chave casarem, vale a última, como na extração original.
+    """
+
+    def __init__(self, rules: list):
+        self.rules = []
+        keywords = set()
+        for key, pattern, formatter, triggers in rules:
+            self.rules.append((key, re.compile(pattern), formatter, tuple(triggers)))
+            keywords.update(triggers)
+        self.prefilter = re.compile("|".join(re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True)))
+
+    def extract(self, message_lower: str) -> dict:
+        """Retorna {chave: valor} com os fatos encontrados na mensagem"""
+        if not self.prefilter.search(message_lower):
+            return {}
+
+        facts = {}
+        for key, pattern, formatter, triggers in self.rules:
+            if not any(trigger in message_lower for trigger in triggers):
+                continue
+            match = pattern.search(message_lower)
+            if not match:
+                continue
             try:
-                key, value = extractor(match)
-                add_or_update_fact(user_id, key, value)
-                print(f"📝 Auto-aprendizado: {user_id} - {key}: {value}")
+                facts[key] = formatter(match.groups())
             except Exception as e:
                 print(f"Erro ao extrair informação: {e}")
-                continue
+        return facts
+
+fact_extractor = FactExtractor(AUTO_LEARN_RULES)
+
+# Mensagens com os fatos que a extração original (um re.search por regra) salvava;
+# --check-facts confere e mede o FactExtractor contra elas
+AUTO_LEARN_GOLDEN_CORPUS = [
+    ("assisto naruto e meu nome é leo", {"anime_favorito": "naruto e meu nome é leo", "nome": "leo"}),
+    ("gosto de ler livros e tenho 20 anos", {"idade": "20 anos", "anime_favorito": "ler livros e tenho 20 anos"}),
+    ("jogo muito valorant e me chamo pedro", {"comida_favorita": "pedro", "jogo_favorito": "valorant e me chamo pedro", "nome": "pedro"}),
+    ("assisto one piece e minha cor favorita é azul", {"anime_favorito": "one piece e minha cor favorita é azul", "cor_favorita": "azul"}),
+    ("tenho 17 anos", {"idade": "17 anos"}),
+    ("eu tenho 25 anos e nasci em 3 de maio de 1999", {"idade": "25 anos", "data_nascimento": "3 de maio de 1999"}),
+    ("meu aniversário é dia 12 de outubro", {"aniversário": "12 de outubro"}),
+    ("minha comida favorita é lasanha", {"comida_favorita": "lasanha"}),
+    ("amo a pizza de calabresa", {"comida_favorita": "pizza"}),
+    ("gosto de jogar minecraft, e você?", {"jogo_favorito": "minecraft", "anime_favorito": "jogar minecraft"}),
+    ("escuto muito radiohead.", {"musica_favorita": "radiohead"}),
+    ("gosto de ouvir jazz", {"anime_favorito": "ouvir jazz", "musica_favorita": "jazz"}),
+    ("ouço muito bach, meu artista favorito é chopin", {"artista_favorito": "bach"}),
+    ("meu anime favorito é bungou stray dogs", {"anime_favorito": "bungou stray dogs"}),
+    ("pode me chamar de akira", {"nome": "akira"}),
+    ("gosto da cor verde", {"cor_favorita": "verde"}),
+    ("gosto do inverno", {"cor_favorita": "inverno"}),
+    ("oi, tudo bem?", {}),
+    ("hoje tá frio demais", {}),
+    ("minha idade é 30 e amo café", {"idade": "30 anos", "comida_favorita": "café"}),
+]
+
+def run_fact_check(rounds: int = 2000):
+    """Confere o FactExtractor contra o corpus de referência e mede o tempo por mensagem"""
+    mismatches = 0
+    for message, expected in AUTO_LEARN_GOLDEN_CORPUS:
+        facts = fact_extractor.extract(message)
+        if facts != expected:
+            mismatches += 1
+            print(f"❌ Fatos diferentes dos esperados: {message!r}")
+            print(f"   esperado: {expected}")
+            print(f"   obtido:   {facts}")
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for message, _ in AUTO_LEARN_GOLDEN_CORPUS:
+            fact_extractor.extract(message)
+    micros = (time.perf_counter() - start) / (rounds * len(AUTO_LEARN_GOLDEN_CORPUS)) * 1_000_000
+
+    print(f"📊 Corpus: {len(AUTO_LEARN_GOLDEN_CORPUS)} mensagens, {mismatches} divergências")
+    print(f"⏱️ {micros:.1f} µs por mensagem")
+    return mismatches == 0
+
+def auto_learn_personal_info(user_id: str, message: str):
+    """Detecta e salva automaticamente informações pessoais importantes"""
+    facts = fact_extractor.extract(message.lower())
+    if not facts:
+        return
+
+    # Todas as informações da mensagem numa única transação
+    add_or_update_facts(user_id, facts)
+    for key, value in facts.items():
+        print(f"📝 Auto-aprendizado: {user_id} - {key}: {value}")
 
 def update_relationship(user_id: str):
-    """Atualiza o nível de relacionamento com um usuário"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    # Escala de 1 a 4000 interações dividida em 11 níveis (0-10)
-    cursor.execute("""
-        INSERT INTO relationships (user_id, interactions, level) 
-        VALUES (?, 1, 0)
-        ON CONFLICT(user_id) 
-        DO UPDATE SET 
-            interactions = interactions + 1,
-            level = CASE 
-                WHEN interactions + 1 >= 4000 THEN 10
-                WHEN interactions + 1 >= 3200 THEN 9
-                WHEN interactions + 1 >= 2400 THEN 8
-                WHEN interactions + 1 >= 1600 THEN 7
-                WHEN interactions + 1 >= 1000 THEN 6
-                WHEN interactions + 1 >= 600 THEN 5
-                WHEN interactions + 1 >= 300 THEN 4
-                WHEN interactions + 1 >= 100 THEN 3
-                WHEN interactions + 1 >= 30 THEN 2
-                WHEN interactions + 1 >= 5 THEN 1
-                ELSE 0
-            END,
-            last_interaction = CURRENT_TIMESTAMP
-    """, (user_id,))
-    conn.commit()
-    conn.close()
+    """Atualiza o nível de relacionamento com um usuário (gravado em lote)"""
+    bookkeeping.add_relationship(user_id)
+
+def get_relationship_level(interactions: int) -> int:
+    """Converte número de interações em nível de relacionamento (0-10)"""
+    for threshold, level in RELATIONSHIP_LEVEL_THRESHOLDS:
+        if interactions >= threshold:
+            return level
+    return 0
 
 def get_relationship(user_id: str):
     """Retorna informações de relacionamento"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT level, interactions FROM relationships WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
+    result = db.fetchone("SELECT level, interactions FROM relationships WHERE user_id = ?", (user_id,))
     return result if result else (0, 0)
 
 def log_interaction(user_id: str, channel_id: str, server_id: str, message: str, response: str):
-    """Registra uma interação no histórico"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO interaction_history (user_id, channel_id, server_id, message_content, bot_response)
-        VALUES (?, ?, ?, ?, ?)
-    """, (user_id, channel_id, server_id, message, response))
-    conn.commit()
-    conn.close()
+    """Registra uma interação no histórico (gravado em lote)"""
+    bookkeeping.add_interaction(user_id, channel_id, server_id, message, response)
 
 def get_stats():
     """Retorna estatísticas gerais"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
     # Total de mensagens hoje
     today = datetime.now().strftime("%Y-%m-%d")
-    cursor.execute("SELECT messages_sent FROM stats WHERE date = ?", (today,))
-    result = cursor.fetchone()
+    result = db.fetchone("SELECT messages_sent FROM stats WHERE date = ?", (today,))
     messages_today = result[0] if result else 0
 
     # Usuários mais próximos (top 5) - Ajustado para considerar 11 níveis
-    cursor.execute("SELECT user_id, level, interactions FROM relationships ORDER BY level DESC, interactions DESC LIMIT 11")
-    top_users = cursor.fetchall()
+    top_users = db.fetchall("SELECT user_id, level, interactions FROM relationships ORDER BY level DESC, interactions DESC LIMIT 11")
 
     # Total de interações
-    cursor.execute("SELECT COUNT(*) FROM interaction_history")
-    total_interactions = cursor.fetchone()[0]
+    total_interactions = db.fetchone("SELECT COUNT(*) FROM interaction_history")[0]
 
-    conn.close()
     return {
         "messages_today": messages_today,
         "top_users": top_users,
@@ -402,60 +1240,59 @@ def get_stats():
     }
 
 def increment_daily_messages():
-    """Incrementa contador de mensagens do dia"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    today = datetime.now().strftime("%Y-%m-%d")
-    cursor.execute("""
-        INSERT INTO stats (date, messages_sent) 
-        VALUES (?, 1)
-        ON CONFLICT(date) 
-        DO UPDATE SET messages_sent = messages_sent + 1
-    """, (today,))
-    conn.commit()
-    conn.close()
+    """Incrementa contador de mensagens do dia (gravado em lote)"""
+    bookkeeping.add_daily_message(datetime.now().strftime("%Y-%m-%d"))
+
+def load_blocked_channels_cache():
+    """Carrega a tabela blocked_channels inteira para o cache em memória"""
+    global blocked_channels_cache
+    cache = {}
+    for channel_id, server_id in db.fetchall("SELECT channel_id, server_id FROM blocked_channels"):
+        cache.setdefault(server_id, set()).add(channel_id)
+    blocked_channels_cache = {server_id: frozenset(channels) for server_id, channels in cache.items()}
+
+def _blocked_channels() -> dict:
+    if blocked_channels_cache is None:
+        load_blocked_channels_cache()
+    return blocked_channels_cache
 
 def block_channel(channel_id: str, server_id: str):
     """Bloqueia um canal para não receber respostas automáticas"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
+    global blocked_channels_cache
+    db.execute("""
         INSERT OR IGNORE INTO blocked_channels (channel_id, server_id) 
         VALUES (?, ?)
     """, (channel_id, server_id))
-    conn.commit()
-    conn.close()
+
+    # Só troca o cache depois do commit (leitores nunca veem estado parcial)
+    cache = _blocked_channels()
+    blocked_channels_cache = {**cache, server_id: cache.get(server_id, frozenset()) | {channel_id}}
 
 def unblock_channel(channel_id: str):
     """Desbloqueia um canal"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM blocked_channels WHERE channel_id = ?", (channel_id,))
-    deleted = cursor.rowcount > 0
-    conn.commit()
-    conn.close()
-    return deleted
-
-def is_channel_blocked(channel_id: str) -> bool:
-    """Verifica se um canal está bloqueado"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM blocked_channels WHERE channel_id = ?", (channel_id,))
-    result = cursor.fetchone()[0] > 0
-    conn.close()
-    return result
+    global blocked_channels_cache
+    removed = db.execute("DELETE FROM blocked_channels WHERE channel_id = ?", (channel_id,)) > 0
+    if removed:
+        blocked_channels_cache = {
+            server_id: channels - {channel_id}
+            for server_id, channels in _blocked_channels().items()
+            if channels - {channel_id}
+        }
+    return removed
+
+def is_channel_blocked(channel_id: str, server_id: str = None) -> bool:
+    """Verifica se um canal está bloqueado (consulta só a memória)"""
+    cache = _blocked_channels()
+    if server_id is not None:
+        return channel_id in cache.get(server_id, ())
+    return any(channel_id in channels for channels in cache.values())
 
 def get_blocked_channels(server_id: str = None):
     """Retorna lista de canais bloqueados"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    cache = _blocked_channels()
     if server_id:
-        cursor.execute("SELECT channel_id FROM blocked_channels WHERE server_id = ?", (server_id,))
-    else:
-        cursor.execute("SELECT channel_id FROM blocked_channels")
-    channels = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return channels
+        return sorted(cache.get(server_id, ()))
+    return sorted(channel_id for channels in cache.values() for channel_id in channels)
 
 # ========== Sistema de Relacionamento com Dalua ==========
 def get_dalua_pronoun_set():
@@ -477,25 +1314,62 @@ def get_dalua_pronoun_set():
             "pronome_possessivo": "dele"
         }
 
-def is_dalua(user_id: str, user_name: str) -> bool:
-    """Verifica se o usuário é a Dalua/Evillyn baseado em ID, nome ou fatos"""
-    # IDs conhecidos da Dalua (Araiko)
-    dalua_ids = ["593590687098863616", 593590687098863616]
-    dalua_names = ["dalua", "evillyn", "evi", "araujo", "araiko", "evillyn araujo"]
+DALUA_NAMES = ["dalua", "evillyn", "evi", "araujo", "araiko", "evillyn araujo"]
 
-    user_lower = user_name.lower()
+# IDs conhecidos da Dalua (Araiko)
+DALUA_KNOWN_IDS = ["593590687098863616"]
+DALUA_FACT_KEY = "é_dalua"
 
-    # Verifica nos fatos do usuário (prioridade máxima)
-    user_facts = get_user_facts(str(user_id))
-    is_dalua_fact = any(fact[0] == "é_dalua" and fact[1] == "true" for fact in user_facts)
+class DaluaIdentityIndex:
+    """
+    Índice de identidade da Dalua, sem consulta ao banco por mensagem: IDs fixos,
+    IDs com o fato é_dalua=true (carregados uma vez e mantidos em dia pelas funções
+    de fatos) e os nomes, casados por um KeywordMatcher pré-compilado.
+    """
 
-    # Verifica ID (converte para string para comparação segura)
-    is_dalua_by_id = str(user_id) in [str(id) for id in dalua_ids]
+    def __init__(self, storage: SQLiteStorage, known_ids: list, name_matcher):
+        self.storage = storage
+        self.known_ids = frozenset(known_ids)
+        self.name_matcher = name_matcher
+        self.fact_ids = None  # None até ser carregado
 
-    # Verifica nome
-    is_dalua_by_name = any(name in user_lower for name in dalua_names)
+    def load(self):
+        rows = self.storage.fetchall("SELECT user_id FROM facts WHERE key = ? AND value = 'true'", (DALUA_FACT_KEY,))
+        self.fact_ids = frozenset(row[0] for row in rows)
+
+    def _fact_ids(self) -> frozenset:
+        if self.fact_ids is None:
+            self.load()
+        return self.fact_ids
+
+    def record_fact(self, user_id: str, key: str, value: str):
+        """Chamado depois de gravar um fato"""
+        if key != DALUA_FACT_KEY:
+            return
+        if value == "true":
+            self.fact_ids = self._fact_ids() | {user_id}
+        else:
+            self.fact_ids = self._fact_ids() - {user_id}
+
+    def forget(self, user_id: str, key: str = None):
+        """Chamado depois de apagar um fato (ou todos, com key=None)"""
+        if key is None or key == DALUA_FACT_KEY:
+            self.fact_ids = self._fact_ids() - {user_id}
+
+    def matches(self, user_id: str, user_name: str) -> bool:
+        user_id = str(user_id)
+        return (
+            user_id in self._fact_ids()
+            or user_id in self.known_ids
+            or bool(user_name and self.name_matcher.match(user_name.lower()))
+        )
 
-    result = is_dalua_fact or is_dalua_by_id or is_dalua_by_name
+def is_dalua(user_id: str, user_name: str) -> bool:
+    """
+    Verifica se o usuário é a Dalua/Evillyn baseado em ID, nome ou fatos.
+    Calcule uma vez por mensagem e repasse o resultado (is_dalua_user) adiante.
+    """
+    result = dalua_index.matches(user_id, user_name)
 
     # Debug log para verificação
     if result:
@@ -503,9 +1377,11 @@ def is_dalua(user_id: str, user_name: str) -> bool:
 
     return result
 
-def get_dalua_relationship_context(user_id: str, user_name: str) -> str:
+def get_dalua_relationship_context(user_id: str, user_name: str, is_dalua_user: bool = None) -> str:
     """Retorna contexto especial para a Dalua"""
-    if not is_dalua(user_id, user_name):
+    if is_dalua_user is None:
+        is_dalua_user = is_dalua(user_id, user_name)
+    if not is_dalua_user:
         return ""
 
     # Obtém conjunto de pronomes variado (60% feminino, 40% masculino)
@@ -661,49 +1537,122 @@ def get_short_acknowledgment() -> str:
     ]
     return random.choice(responses)
 
-def should_participate_in_conversation(message_content: str, channel_history: list = None) -> dict:
-    """
-    Detecta se o bot deve participar da conversa baseado no conteúdo e contexto.
-    Retorna dict com 'should_respond' (bool) e 'use_reply' (bool)
-    """
-    content_lower = message_content.lower()
+# Tópicos e palavras-chave relacionados aos gostos do Akutagawa
+AKUTAGAWA_TOPICS = [
+    # Literatura
+    "livro", "ler", "leitura", "autor", "edgar", "poe", "dostoevsky", "dazai", 
+    "kafka", "nietzsche", "camus", "poesia", "romance", "conto",
 
-    # Tópicos e palavras-chave relacionados aos gostos do Akutagawa
-    akutagawa_topics = [
-        # Literatura
-        "livro", "ler", "leitura", "autor", "edgar", "poe", "dostoevsky", "dazai", 
-        "kafka", "nietzsche", "camus", "poesia", "romance", "conto",
+    # Temas filosóficos
+    "existência", "solidão", "morte", "mortalidade", "força", "fraqueza",
+    "significado", "vazio", "caos", "escuridão", "sombra",
 
-        # Temas filosóficos
-        "existência", "solidão", "morte", "mortalidade", "força", "fraqueza",
-        "significado", "vazio", "caos", "escuridão", "sombra",
+    # Gatos
+    "gato", "romeu", "felino", "pet", "animal de estimação",
 
-        # Gatos
-        "gato", "romeu", "felino", "pet", "animal de estimação",
+    # Ambientes/atividades
+    "café", "chuva", "noite", "silêncio", "biblioteca", "shogi",
 
-        # Ambientes/atividades
-        "café", "chuva", "noite", "silêncio", "biblioteca", "shogi",
+    # Bungo Stray Dogs
+    "bungo", "bsd", "port mafia", "atsushi", "gin", "habilidade",
 
-        # Bungo Stray Dogs
-        "bungo", "bsd", "port mafia", "atsushi", "gin", "habilidade",
+    # Arte e cultura
+    "música", "arte", "filosofia", "estratégia", "poema"
+]
 
-        # Arte e cultura
-        "música", "arte", "filosofia", "estratégia", "poema"
-    ]
+QUESTION_MARKERS = ["?", "por que", "porque", "como", "qual", "quando", "onde", "o que"]
+DEEP_DISCUSSION_WORDS = ["acha", "pensa", "concorda", "opinião", "acredita", "sente"]
+BOT_NAMES = ["akutagawa", "aku", "ryunosuke", "ryūnosuke"]
+TIME_KEYWORDS = ["que horas são", "qual a hora", "horas agora", "que horas é", "hora atual", "horário"]
+DATE_KEYWORDS = ["que dia é", "qual o dia", "data de hoje", "hoje é", "qual a data", "data atual"]
 
-    # Detecta menções diretas (nome do bot)
-    bot_mentions = ["akutagawa", "aku", "ryunosuke", "ryūnosuke"]
-    is_mentioned = any(mention in content_lower for mention in bot_mentions)
+class KeywordMatcher:
+    """
+    Casamento de várias listas de palavras-chave numa única passada (Aho-Corasick).
+    O autômato é compilado em tabela de transições completa na construção, então
+    cada caractere da mensagem custa uma consulta de dicionário, sem backtracking.
+    match() devolve o conjunto de categorias com pelo menos uma ocorrência.
+    """
 
-    # Detecta tópicos de interesse
-    has_interest_topic = any(topic in content_lower for topic in akutagawa_topics)
+    def __init__(self, categories: dict):
+        goto = [{}]
+        outputs = [set()]
+        for category, keywords in categories.items():
+            for keyword in keywords:
+                state = 0
+                for char in keyword.lower():
+                    if char not in goto[state]:
+                        goto.append({})
+                        outputs.append(set())
+                        goto[state][char] = len(goto) - 1
+                    state = goto[state][char]
+                outputs[state].add(category)
+
+        # Links de falha em largura; cada estado herda as transições e saídas do seu link
+        fail = [0] * len(goto)
+        order = [0]
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            order.append(state)
+            for char, child in goto[state].items():
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[child] = goto[fallback].get(char, 0) if state else 0
+                outputs[child] |= outputs[fail[child]]
+                queue.append(child)
+
+        self.transitions = [None] * len(goto)
+        self.outputs = [None] * len(goto)
+        for state in order:
+            table = dict(self.transitions[fail[state]]) if state else {}
+            table.update(goto[state])
+            self.transitions[state] = table
+            self.outputs[state] = frozenset(outputs[state]) or None
+
+        self.total_keywords = sum(len(keywords) for keywords in categories.values())
+
+    def match(self, text_lower: str) -> set:
+        """Categorias encontradas no texto (já em minúsculas)"""
+        transitions = self.transitions
+        outputs = self.outputs
+        hits = set()
+        state = 0
+        for char in text_lower:
+            state = transitions[state].get(char, 0)
+            if outputs[state]:
+                hits |= outputs[state]
+        return hits
+
+keyword_matcher = KeywordMatcher({
+    "topico": AKUTAGAWA_TOPICS,
+    "mencao": BOT_NAMES,
+    "pergunta": QUESTION_MARKERS,
+    "discussao": DEEP_DISCUSSION_WORDS,
+    "hora": TIME_KEYWORDS,
+    "data": DATE_KEYWORDS,
+})
+
+# Índice de identidade da Dalua (os nomes usam um autômato próprio, só com DALUA_NAMES)
+dalua_index = DaluaIdentityIndex(db, DALUA_KNOWN_IDS, KeywordMatcher({"dalua": DALUA_NAMES}))
+
+def should_participate_in_conversation(message_content: str, channel_history: list = None, guild = None) -> dict:
+    """
+    Detecta se o bot deve participar da conversa baseado no conteúdo e contexto.
+    Retorna dict com 'should_respond' (bool) e 'use_reply' (bool)
+    """
+    content_lower = message_content.lower()
 
-    # Detecta perguntas diretas ou discussões profundas
-    is_question = any(q in content_lower for q in ["?", "por que", "porque", "como", "qual", "quando", "onde", "o que"])
-    is_deep_discussion = any(word in content_lower for word in ["acha", "pensa", "concorda", "opinião", "acredita", "sente"])
+    # Uma passada só detecta menções, tópicos de interesse, perguntas e discussões
+    hits = keyword_matcher.match(content_lower)
+    is_mentioned = "mencao" in hits
+    has_interest_topic = "topico" in hits
+    is_question = "pergunta" in hits
+    is_deep_discussion = "discussao" in hits
 
     # Chance aleatória de participar (varia de 10% a 40% dependendo do humor)
-    mood = get_bot_config("current_mood", "neutro")
+    mood = get_guild_config(guild, "current_mood", "neutro")
     participation_chances = {
         "feliz": 0.35,
         "reflexivo": 0.40,
@@ -741,8 +1690,7 @@ def decide_message_count(prompt: str, response: str, is_dalua: bool = False) ->
     response_lower = response.lower().strip()
 
     # Saudações básicas: SEMPRE responde com 1-2 mensagens curtas
-    greetings = ["oi", "olá", "ola", "hey", "e ai", "eae", "salve"]
-    if prompt_lower in greetings:
+    if prompt_lower in GREETING_WORDS:
         return random.choice([1, 2])  # 50% chance de responder com 2 mensagens
 
     # Respostas de despedida/finais: sempre 1 mensagem
@@ -794,8 +1742,160 @@ def decide_message_count(prompt: str, response: str, is_dalua: bool = False) ->
 
     return random.choice([1, 2, 2])  # Mesmo no fallback, favorece 2
 
+# Pesos dos pontos de quebra entre palavras (0 = quebra só por tamanho)
+BREAK_WEIGHT_LINE = 5       # quebra de linha
+BREAK_WEIGHT_SENTENCE = 4   # fim de frase: . ! ? ...
+BREAK_WEIGHT_CLAUSE = 3     # ; : e travessão
+BREAK_WEIGHT_CONNECTOR = 2  # antes de "mas", "porém", "então"...
+BREAK_WEIGHT_COMMA = 2
+BREAK_WEIGHT_COMMA_CONTINUATION = 1  # vírgula seguida de "de", "que", "e"... (a frase continua)
+BREAK_WEIGHT_ADDITION = 2   # antes de "além disso", "e também"
+BREAK_WEIGHT_SUBORDINATE = 1  # antes de "porque", "quando", "embora"...
+BREAK_WEIGHT_BOUND = -1     # logo depois de preposição/artigo ("sem | açúcar")
+
+# Quanto custa uma parte fugir do tamanho ideal (desvio relativo ao quadrado)
+SPLIT_BALANCE_PENALTY = 2.5
+
+TAIL_WEIGHTS = {
+    ".": BREAK_WEIGHT_SENTENCE, "!": BREAK_WEIGHT_SENTENCE, "?": BREAK_WEIGHT_SENTENCE, "…": BREAK_WEIGHT_SENTENCE,
+    ";": BREAK_WEIGHT_CLAUSE, ":": BREAK_WEIGHT_CLAUSE, ",": BREAK_WEIGHT_COMMA,
+}
+CLOSING_MARKS = '"\')]*'
+DASHES = {"-", "—", "–"}
+STRONG_CONNECTORS = {"mas", "porém", "contudo", "todavia", "entretanto", "então", "aliás", "enfim"}
+CONTINUATION_WORDS = {"de", "com", "em", "se", "sobre", "para", "que", "e", "ou"}
+SUBORDINATE_WORDS = {"porque", "pois", "quando", "enquanto", "embora", "apesar", "senão"}
+ADDITION_CONNECTORS = {("e", "também"), ("além", "disso")}
+BOUND_WORDS = CONTINUATION_WORDS | {
+    "o", "a", "os", "as", "um", "uma", "no", "na", "nos", "nas", "do", "da", "dos", "das",
+    "ao", "à", "sem", "por", "pelo", "pela", "meu", "minha", "seu", "sua", "mais", "muito", "tão", "não",
+}
+
+def tokenize_for_split(text: str) -> tuple:
+    """
+    Uma passada pelo texto: devolve as palavras (com pontuação grudada) e, para cada
+    fronteira entre a palavra i e a i+1, o peso dessa fronteira como ponto de quebra.
+    """
+    words = []
+    weights = []
+    previous_tail = 0
+    previous_head = ""
+    for line in text.split("\n"):
+        line_words = line.split()
+        if not line_words:
+            continue
+        starts_line = bool(words)
+        for word, lowered in zip(line_words, line.lower().split()):
+            head = lowered.strip('"\'()[],;:')
+            if words:
+                if starts_line:
+                    weight = BREAK_WEIGHT_LINE
+                    starts_line = False
+                else:
+                    weight = previous_tail
+                    if not weight and previous_head in BOUND_WORDS:
+                        weight = BREAK_WEIGHT_BOUND
+                    elif weight == BREAK_WEIGHT_COMMA and head in CONTINUATION_WORDS:
+                        weight = BREAK_WEIGHT_COMMA_CONTINUATION
+                    if head in STRONG_CONNECTORS and weight < BREAK_WEIGHT_SENTENCE:
+                        weight = weight + 1 if weight > 0 else BREAK_WEIGHT_CONNECTOR
+                    elif head in SUBORDINATE_WORDS and weight <= 0:
+                        weight = BREAK_WEIGHT_SUBORDINATE
+                weights.append(weight)
+
+                # Conectores de duas palavras: a quebra fica antes da primeira
+                if (previous_head, head) in ADDITION_CONNECTORS and len(weights) >= 2:
+                    weights[-2] = max(weights[-2], BREAK_WEIGHT_ADDITION)
+
+            last = word[-1]
+            if last in CLOSING_MARKS:
+                last = word.rstrip(CLOSING_MARKS)[-1:]
+            previous_tail = TAIL_WEIGHTS.get(last, 0)
+            if word in DASHES:
+                previous_tail = BREAK_WEIGHT_CLAUSE
+            words.append(word)
+            previous_head = head
+    return words, weights
+
+def plan_split_points(weights: list, num_parts: int) -> list:
+    """
+    Escolhe num_parts - 1 fronteiras maximizando a soma dos pesos menos a penalidade
+    de desequilíbrio entre as partes (programação dinâmica sobre as candidatas).
+    Candidatas: fronteiras com peso positivo e as vizinhas de cada corte ideal, então
+    sempre há fronteiras suficientes mesmo sem pontuação nenhuma.
+    """
+    word_count = len(weights) + 1
+    ideal = word_count / num_parts
+    candidates = {i + 1 for i, weight in enumerate(weights) if weight > 0}
+    for part in range(1, num_parts):
+        center = round(part * ideal)
+        candidates.update(range(max(1, center - 1), min(word_count - 1, center + 1) + 1))
+    positions = sorted(candidates)
+    gains = [weights[position - 1] for position in positions]
+    penalty = SPLIT_BALANCE_PENALTY / (ideal * ideal)
+    count = len(positions)
+
+    # best[p]: melhor pontuação com o último corte em positions[p]; paths guarda os cortes
+    best = [gains[p] - penalty * (positions[p] - ideal) ** 2 for p in range(count)]
+    paths = [[position] for position in positions]
+    for _ in range(num_parts - 2):
+        next_best = [None] * count
+        next_paths = [None] * count
+        for p in range(1, count):
+            end = positions[p]
+            top = None
+            top_q = 0
+            for q in range(p):
+                if best[q] is None:
+                    continue
+                score = best[q] - penalty * (end - positions[q] - ideal) ** 2
+                if top is None or score > top:
+                    top = score
+                    top_q = q
+            if top is not None:
+                next_best[p] = top + gains[p]
+                next_paths[p] = paths[top_q] + [end]
+        best, paths = next_best, next_paths
+
+    # Última parte vai do último corte até o fim do texto
+    top = None
+    top_p = 0
+    for p in range(count):
+        if best[p] is None:
+            continue
+        score = best[p] - penalty * (word_count - positions[p] - ideal) ** 2
+        if top is None or score > top:
+            top = score
+            top_p = p
+    return paths[top_p]
+
 def split_response_naturally(text: str, num_parts: int) -> list:
-    """Divide uma resposta em múltiplas partes de forma contextual e natural"""
+    """
+    Divide uma resposta em exatamente num_parts mensagens (ou uma por palavra, se
+    houver menos palavras), preferindo fins de frase, depois ; : e conectores, depois
+    vírgulas, e mantendo as partes com tamanhos parecidos.
+    """
+    text = text.strip()
+    if num_parts <= 1 or not text:
+        return [text]
+
+    words, weights = tokenize_for_split(text)
+    num_parts = min(num_parts, len(words))
+    if num_parts == 1:
+        return [text]
+
+    cuts = plan_split_points(weights, num_parts)
+    parts = []
+    start = 0
+    for end in cuts + [len(words)]:
+        part = " ".join(words[start:end])
+        # Vírgula ou ponto e vírgula no fim da mensagem fica estranho no chat
+        parts.append(part.rstrip(",;") if end < len(words) else part)
+        start = end
+    return parts
+
+def split_response_legacy(text: str, num_parts: int) -> list:
+    """Divisão antiga (re.split em frases, vírgulas e conectores); mantida só para o benchmark"""
     if num_parts == 1:
         return [text]
 
@@ -974,6 +2074,111 @@ def split_response_naturally(text: str, num_parts: int) -> list:
 
     return sentences if sentences else [text]
 
+# Respostas reais do bot com a divisão esperada; --bench-split confere e mede contra a versão antiga
+SPLIT_GOLDEN_CORPUS = [
+    ("hm, não sei se concordo. kafka escreve sobre a prisão do cotidiano, mas dazai só reclama da vida.", 2, [
+        "hm, não sei se concordo.",
+        "kafka escreve sobre a prisão do cotidiano, mas dazai só reclama da vida.",
+    ]),
+    ("hm, não sei se concordo. kafka escreve sobre a prisão do cotidiano, mas dazai só reclama da vida.", 3, [
+        "hm, não sei se concordo.",
+        "kafka escreve sobre a prisão do cotidiano",
+        "mas dazai só reclama da vida.",
+    ]),
+    ("tô lendo rashomon de novo, é curioso como cada releitura muda o sentido da história", 2, [
+        "tô lendo rashomon de novo",
+        "é curioso como cada releitura muda o sentido da história",
+    ]),
+    ("eu gosto de café preto sem açúcar porque o amargor me lembra que ainda estou acordado e isso basta", 3, [
+        "eu gosto de café preto sem açúcar",
+        "porque o amargor me lembra",
+        "que ainda estou acordado e isso basta",
+    ]),
+    ("a chuva lá fora tá forte. o romeu tá dormindo no meu colo; nem quer saber de nada. além disso, o chá esfriou", 3, [
+        "a chuva lá fora tá forte.",
+        "o romeu tá dormindo no meu colo; nem quer saber de nada.",
+        "além disso, o chá esfriou",
+    ]),
+    ("sinceramente? não ligo. faça o que quiser, eu só vou observar", 2, [
+        "sinceramente? não ligo.",
+        "faça o que quiser, eu só vou observar",
+    ]),
+    ("boa noite. dorme bem", 2, [
+        "boa noite.",
+        "dorme bem",
+    ]),
+    ("...hm. talvez", 2, [
+        "...hm.",
+        "talvez",
+    ]),
+    ("fraqueza não é desculpa. se você quer ser forte, treina todo dia e para de reclamar", 2, [
+        "fraqueza não é desculpa.",
+        "se você quer ser forte, treina todo dia e para de reclamar",
+    ]),
+    ("o silêncio da biblioteca à noite é a única coisa que me acalma de verdade, o resto é barulho demais pra mim", 2, [
+        "o silêncio da biblioteca à noite é a única coisa que me acalma de verdade",
+        "o resto é barulho demais pra mim",
+    ]),
+    ("minha estrela, você já comeu hoje? não quero saber de você pulando refeição de novo. vai lá comer alguma coisa, tá?", 3, [
+        "minha estrela, você já comeu hoje?",
+        "não quero saber de você pulando refeição de novo.",
+        "vai lá comer alguma coisa, tá?",
+    ]),
+    ("shogi é estratégia pura: cada peça tem um propósito, e quem perde a paciência perde o jogo", 2, [
+        "shogi é estratégia pura:",
+        "cada peça tem um propósito, e quem perde a paciência perde o jogo",
+    ]),
+    ("não tenho opinião formada sobre isso ainda, porém acho que a morte dá sentido à existência, então talvez camus tenha razão, mas só talvez", 4, [
+        "não tenho opinião formada sobre isso ainda",
+        "porém acho que a morte dá sentido à existência",
+        "então talvez camus tenha razão",
+        "mas só talvez",
+    ]),
+    ("interessante\nmas não muda nada do que eu disse antes sobre o gin", 2, [
+        "interessante",
+        "mas não muda nada do que eu disse antes sobre o gin",
+    ]),
+    ("tsc. você de novo", 3, [
+        "tsc.",
+        "você",
+        "de novo",
+    ]),
+    ("li três capítulos hoje e também terminei aquele poema que comecei semana passada, além disso o gato derrubou minha xícara", 3, [
+        "li três capítulos hoje",
+        "e também terminei aquele poema que comecei semana passada",
+        "além disso o gato derrubou minha xícara",
+    ]),
+]
+
+def run_split_benchmark(rounds: int = 2000):
+    """Confere o corpus de referência e compara o tempo por chamada com split_response_legacy"""
+    mismatches = 0
+    legacy_wrong_count = 0
+    for text, num_parts, expected in SPLIT_GOLDEN_CORPUS:
+        parts = split_response_naturally(text, num_parts)
+        if parts != expected:
+            mismatches += 1
+            print(f"❌ Divisão diferente da esperada ({num_parts} partes): {text!r}")
+            print(f"   esperado: {expected}")
+            print(f"   obtido:   {parts}")
+        if len(split_response_legacy(text, num_parts)) != len(expected):
+            legacy_wrong_count += 1
+
+    timings = {}
+    for name, split in (("atual", split_response_naturally), ("antiga", split_response_legacy)):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for text, num_parts, _ in SPLIT_GOLDEN_CORPUS:
+                split(text, num_parts)
+        elapsed = time.perf_counter() - start
+        timings[name] = elapsed / (rounds * len(SPLIT_GOLDEN_CORPUS)) * 1_000_000
+
+    print(f"📊 Corpus: {len(SPLIT_GOLDEN_CORPUS)} respostas, {mismatches} divergências")
+    print(f"📊 Versão antiga devolveu número errado de partes em {legacy_wrong_count} respostas")
+    for name, micros in timings.items():
+        print(f"⏱️ {name}: {micros:.1f} µs por chamada")
+    return mismatches == 0
+
 def get_available_emotes(guild) -> str:
     """Retorna lista de emotes disponíveis no servidor"""
     if not guild:
@@ -1000,71 +2205,291 @@ REGRAS PARA USO DE EMOTES:
 - Emojis padrão (😊 ❤️ etc) podem ser usados normalmente
 """
 
-def generate_ai_response(prompt: str, system_prompt: str, user_id: str = "", user_name: str = "", channel_id: str = "", guild = None) -> str:
-    """Gera resposta usando Gemini com contexto personalizado"""
-    tone = get_bot_config("tone", "neutro")
-    mood = get_bot_config("current_mood", "neutro")
-
-    # Adiciona lista de emotes disponíveis
-    emotes_context = get_available_emotes(guild)
+# ========== Respostas Locais (sem IA) ==========
+# Saudações básicas (também usadas por decide_message_count)
+GREETING_WORDS = ["oi", "olá", "ola", "hey", "e ai", "eae", "salve"]
+
+DIAS_SEMANA = {
+    'Monday': 'segunda-feira',
+    'Tuesday': 'terça-feira',
+    'Wednesday': 'quarta-feira',
+    'Thursday': 'quinta-feira',
+    'Friday': 'sexta-feira',
+    'Saturday': 'sábado',
+    'Sunday': 'domingo'
+}
 
-    # Adiciona contexto do Akutagawa
-    akutagawa_context = get_akutagawa_context()
+class LocalResponder:
+    """
+    Respostas locais para mensagens triviais, testadas antes de montar qualquer prompt.
+    Cada regra recebe (texto normalizado, texto original, é_dalua) e retorna a resposta
+    ou None; a primeira regra que responder vence. Novas regras entram com @local_responder.rule.
+    """
 
-    # IMPORTANTE: Verifica se É ESPECIFICAMENTE a Dalua
-    is_dalua_user = is_dalua(user_id, user_name)
+    def __init__(self):
+        self.rules = []
+        self.hits = {}
+
+    def rule(self, name: str):
+        def register(func):
+            self.rules.append((name, func))
+            self.hits[name] = 0
+            return func
+        return register
+
+    def respond(self, content: str, is_dalua_user: bool = False) -> Optional[str]:
+        normalized = normalize_prompt(content)
+        for name, func in self.rules:
+            response = func(normalized, content, is_dalua_user)
+            if response:
+                self.hits[name] += 1
+                return response
+        return None
+
+local_responder = LocalResponder()
+
+@local_responder.rule("hora_data")
+def respond_time_date(normalized: str, content: str, is_dalua_user: bool) -> Optional[str]:
+    """Perguntas de hora e data respondidas com o horário de Brasília"""
+    hits = keyword_matcher.match(content.lower())
+    is_time_query = "hora" in hits
+    is_date_query = "data" in hits
+    if not is_time_query and not is_date_query:
+        return None
 
-    # Adiciona contexto especial APENAS para Dalua
-    dalua_context = get_dalua_relationship_context(user_id, user_name)
+    brazil_time = get_brazil_time()
+    if is_time_query and is_date_query:
+        if is_dalua_user:
+            return f"minha estrela, agora são {brazil_time.strftime('%H:%M')} de {brazil_time.strftime('%d/%m/%Y')}, tá?"
+        return f"são {brazil_time.strftime('%H:%M')} de {brazil_time.strftime('%d/%m/%Y')}."
+    if is_time_query:
+        if is_dalua_user:
+            return f"amor, agora são {brazil_time.strftime('%H:%M')}"
+        return f"são {brazil_time.strftime('%H:%M')}."
 
-    # Ajusta tom automaticamente APENAS para Dalua
+    day_name_en = brazil_time.strftime('%A')
+    day_name = DIAS_SEMANA.get(day_name_en, day_name_en)
     if is_dalua_user:
-        tone = "extremamente carinhoso e amoroso"
-        mood = "apaixonado"
+        return f"minha querida, hoje é {day_name}, {brazil_time.strftime('%d/%m/%Y')}"
+    return f"hoje é {day_name}, {brazil_time.strftime('%d/%m/%Y')}."
+
+@local_responder.rule("desinteresse")
+def respond_acknowledgment(normalized: str, content: str, is_dalua_user: bool) -> Optional[str]:
+    """Sinais de desinteresse recebem só um reconhecimento curto"""
+    if should_ignore_message(content):
+        return get_short_acknowledgment()
+    return None
+
+GREETING_REPLIES = {
+    "comum": ["hm.", "o que foi?", "...oi.", "fala.", "tsc. o que você quer?"],
+    "dalua": ["oi, minha estrela", "oi amor. estava pensando em você", "finalmente apareceu. senti sua falta"],
+}
+PERIOD_GREETINGS = {"bom dia": "manhã", "boa tarde": "tarde", "boa noite": "noite"}
+PERIOD_GREETING_REPLIES = {
+    "comum": ["{saudacao}.", "hm. {saudacao}.", "{saudacao}. o que quer?"],
+    "dalua": ["{saudacao}, meu amor", "{saudacao}, minha estrela", "{saudacao}, amor"],
+}
 
-    # Obtém hora e data atual de Brasília
-    brazil_time = get_brazil_time()
+@local_responder.rule("saudacao")
+def respond_greeting(normalized: str, content: str, is_dalua_user: bool) -> Optional[str]:
+    """Saudações simples ("oi", "salve", "bom dia")"""
+    user_class = "dalua" if is_dalua_user else "comum"
+    if normalized in GREETING_NORMALIZED:
+        return random.choice(GREETING_REPLIES[user_class])
+    if normalized in PERIOD_GREETINGS:
+        return random.choice(PERIOD_GREETING_REPLIES[user_class]).format(saudacao=normalized)
+    return None
+
+THANKS_WORDS = ["obrigado", "obrigada", "obg", "brigado", "brigada", "vlw", "valeu", "thanks", "muito obrigado", "muito obrigada"]
+THANKS_REPLIES = {
+    "comum": ["não precisa agradecer.", "hm.", "tanto faz.", "não fiz por você."],
+    "dalua": ["sempre, meu amor", "pra você, qualquer coisa", "não precisa agradecer, minha estrela"],
+}
 
-    # Traduz dias da semana para português brasileiro
-    dias_semana = {
-        'Monday': 'segunda-feira',
-        'Tuesday': 'terça-feira',
-        'Wednesday': 'quarta-feira',
-        'Thursday': 'quinta-feira',
-        'Friday': 'sexta-feira',
-        'Saturday': 'sábado',
-        'Sunday': 'domingo'
-    }
+@local_responder.rule("agradecimento")
+def respond_thanks(normalized: str, content: str, is_dalua_user: bool) -> Optional[str]:
+    if normalized in THANKS_NORMALIZED:
+        return random.choice(THANKS_REPLIES["dalua" if is_dalua_user else "comum"])
+    return None
 
-    day_name_en = brazil_time.strftime('%A')
-    day_name_pt = dias_semana.get(day_name_en, day_name_en)
+GOODBYE_WORDS = ["tchau", "bye", "adeus", "flw", "falou", "até mais", "até logo", "até amanhã", "fui"]
+GOODBYE_REPLIES = {
+    "comum": ["vai.", "hm. até.", "tchau.", "finalmente."],
+    "dalua": ["tchau, amor. se cuida", "até logo, minha estrela. vou sentir sua falta", "vai com cuidado, tá?"],
+}
 
-    current_datetime = f"HORA E DATA ATUAL: {brazil_time.strftime('%H:%M')} de {day_name_pt}, {brazil_time.strftime('%d/%m/%Y')}"
+@local_responder.rule("despedida")
+def respond_goodbye(normalized: str, content: str, is_dalua_user: bool) -> Optional[str]:
+    if normalized in GOODBYE_NORMALIZED:
+        return random.choice(GOODBYE_REPLIES["dalua" if is_dalua_user else "comum"])
+    return None
+
+# Risadas e reações curtas ("kkkk", "hahaha", "rs", "lol")
+REACTION_PATTERN = re.compile(r'^(?:k+|(?:ha)+h?|(?:he)+h?|(?:hue)+|rs+|lol)$')
+REACTION_REPLIES = {
+    "comum": ["do que você tá rindo?", "tsc.", "...", "não tem graça."],
+    "dalua": ["adoro sua risada", "do que você tá rindo, amor?", "bobinha"],
+}
 
-    # Adiciona contexto da conversa atual
-    conversation_context_text = get_conversation_context(channel_id) if channel_id else ""
+@local_responder.rule("reacao")
+def respond_reaction(normalized: str, content: str, is_dalua_user: bool) -> Optional[str]:
+    if REACTION_PATTERN.match(normalized):
+        return random.choice(REACTION_REPLIES["dalua" if is_dalua_user else "comum"])
+    return None
+
+# ========== Agendador de Requisições de IA ==========
+# Classes de prioridade (menor número = mais importante)
+PRIORITY_DIRECT = 0            # DM e menção direta
+PRIORITY_DEFAULT_CHANNEL = 1   # Canal padrão
+PRIORITY_PARTICIPATION = 2     # Participação inteligente (respondall)
+PRIORITY_SUMMARY = 3           # Resumo do contexto em segundo plano
+PRIORITY_SPONTANEOUS = 4       # Conversas espontâneas
+
+# reserve: fração do orçamento que esta classe NÃO pode consumir (fica para as mais importantes)
+# max_wait: quanto tempo (s) a requisição pode esperar na fila antes de ser descartada
+AI_PRIORITY_POLICY = {
+    PRIORITY_DIRECT: {"name": "direta", "reserve": 0.0, "max_wait": 30},
+    PRIORITY_DEFAULT_CHANNEL: {"name": "canal padrão", "reserve": 0.2, "max_wait": 15},
+    PRIORITY_PARTICIPATION: {"name": "participação", "reserve": 0.4, "max_wait": 5},
+    # Ninguém espera pelo resumo: pode aguardar a cota, mas sem disputar com as respostas
+    PRIORITY_SUMMARY: {"name": "resumo", "reserve": 0.5, "max_wait": 60},
+    PRIORITY_SPONTANEOUS: {"name": "espontânea", "reserve": 0.6, "max_wait": 0},
+}
 
-    # Adiciona identificação explícita do usuário atual
-    user_identity = f"""
+class AIRequestDropped(Exception):
+    """Requisição de IA descartada pelo agendador para preservar a cota"""
 
-IDENTIFICAÇÃO DO USUÁRIO ATUAL:
-- ID do usuário: {user_id}
-- Nome do usuário: {user_name}
-- Este é {"DALUA/EVILYN/ARAIKO (SUA NAMORADA)" if is_dalua_user else "UM USUÁRIO COMUM (NÃO é Dalua)"}
-- {"Use tratamento CARINHOSO e AMOROSO com este usuário específico" if is_dalua_user else "Mantenha sua personalidade normal de Akutagawa (frio, direto, sarcástico)"}
-"""
+def estimate_tokens(text: str) -> int:
+    """Estimativa barata de tokens (~4 caracteres por token)"""
+    return len(text) // 4 + 1
 
-    # Adiciona instruções de estilo de resposta
-    style_instructions = f"""
+class TokenBucket:
+    """Balde de tokens com reposição contínua"""
 
-{current_datetime}
-{user_identity}
-{conversation_context_text}
-{emotes_context}
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.level = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def time_until(self, amount: float) -> float:
+        """Segundos até existir `amount` disponível no balde (0 se já existe)"""
+        self._refill()
+        missing = amount - self.level
+        if missing <= 0:
+            return 0.0
+        return missing / self.refill_per_second if self.refill_per_second > 0 else float("inf")
+
+    def consume(self, amount: float):
+        self._refill()
+        self.level -= amount  # Pode ficar negativo quando o uso real supera a estimativa
+
+class AIRequestScheduler:
+    """
+    Controla o acesso à IA com orçamento de requisições/minuto e tokens/minuto.
+    Requisições de menor prioridade só passam enquanto sobra orçamento acima da
+    reserva delas e nunca furam a fila de uma classe mais importante; se não
+    conseguirem passar dentro de max_wait, são descartadas.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60)
+        self.waiting = {priority: 0 for priority in AI_PRIORITY_POLICY}
+        self.granted = {priority: 0 for priority in AI_PRIORITY_POLICY}
+        self.dropped = {priority: 0 for priority in AI_PRIORITY_POLICY}
+
+    def _has_higher_priority_waiting(self, priority: int) -> bool:
+        return any(count for other, count in self.waiting.items() if other < priority)
+
+    def _needed(self, policy: dict, estimated_tokens: int) -> tuple:
+        """
+        Nível de balde exigido para liberar a requisição (pedido + reserva da classe).
+        Limitado à capacidade: um prompt maior que (1 - reserva) * capacidade ainda
+        passa com o balde cheio, em vez de esperar até max_wait e ser descartado.
+        """
+        needed_requests = min(1 + policy["reserve"] * self.requests.capacity, self.requests.capacity)
+        needed_tokens = min(estimated_tokens + policy["reserve"] * self.tokens.capacity, self.tokens.capacity)
+        return needed_requests, needed_tokens
+
+    async def acquire(self, priority: int, estimated_tokens: int):
+        """Espera por orçamento para uma requisição. Levanta AIRequestDropped se não couber"""
+        policy = AI_PRIORITY_POLICY[priority]
+        deadline = time.monotonic() + policy["max_wait"]
+        estimated_tokens = min(estimated_tokens, self.tokens.capacity)
+        needed_requests, needed_tokens = self._needed(policy, estimated_tokens)
+
+        self.waiting[priority] += 1
+        try:
+            while True:
+                if self._has_higher_priority_waiting(priority):
+                    wait = 0.25
+                else:
+                    wait = max(self.requests.time_until(needed_requests), self.tokens.time_until(needed_tokens))
+                    if wait <= 0:
+                        self.requests.consume(1)
+                        self.tokens.consume(estimated_tokens)
+                        self.granted[priority] += 1
+                        return
+
+                remaining = deadline - time.monotonic()
+                if wait > remaining:
+                    self.dropped[priority] += 1
+                    raise AIRequestDropped(f"Requisição '{policy['name']}' descartada: orçamento de IA esgotado")
+                await asyncio.sleep(wait)
+        finally:
+            self.waiting[priority] -= 1
+
+    def try_acquire(self, priority: int, estimated_tokens: int) -> bool:
+        """Versão sem espera de acquire: consome o orçamento só se ele estiver disponível agora"""
+        policy = AI_PRIORITY_POLICY[priority]
+        estimated_tokens = min(estimated_tokens, self.tokens.capacity)
+        if self._has_higher_priority_waiting(priority):
+            return False
+        needed_requests, needed_tokens = self._needed(policy, estimated_tokens)
+        if self.requests.time_until(needed_requests) > 0 or self.tokens.time_until(needed_tokens) > 0:
+            return False
+        self.requests.consume(1)
+        self.tokens.consume(estimated_tokens)
+        return True
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int):
+        """Corrige o balde de tokens com o uso real informado pela API"""
+        if actual_tokens:
+            self.tokens.consume(actual_tokens - min(estimated_tokens, self.tokens.capacity))
+
+ai_scheduler = AIRequestScheduler(AI_REQUESTS_PER_MINUTE, AI_TOKENS_PER_MINUTE)
+
+# ========== Geração de Respostas com IA ==========
+def is_rate_limit_error(error: Exception) -> bool:
+    """Detecta erro de limite de taxa/cota (ResourceExhausted do Gemini ou HTTP 429)"""
+    if isinstance(error, google_exceptions.ResourceExhausted):
+        return True
+    if getattr(error, "code", None) == 429 or getattr(error, "status_code", None) == 429:
+        return True
+    error_msg = str(error)
+    return "RESOURCE_EXHAUSTED" in error_msg or "quota" in error_msg.lower()
+
+def is_failover_error(error: Exception) -> bool:
+    """Erros que contam para o circuit breaker e justificam tentar o próximo provedor"""
+    if is_rate_limit_error(error):
+        return True
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, google_exceptions.DeadlineExceeded, google_exceptions.ServiceUnavailable)):
+        return True
+    if "timeout" in type(error).__name__.lower():
+        return True  # openai.APITimeoutError, httpx.ReadTimeout...
+    status = getattr(error, "code", None) or getattr(error, "status_code", None)
+    return isinstance(status, int) and status >= 500
+
+# Regras de estilo fixas: entram na instrução de sistema pré-compilada
+STATIC_STYLE_RULES = """
 
 INSTRUÇÕES IMPORTANTES DE ESTILO E COERÊNCIA:
-- Tom de conversa: {tone}
-- Humor atual: {mood}
 - Responda de forma NATURAL, como em uma conversa real de chat
 - Seja CONCISO: respostas curtas (5-30 palavras) quando apropriado
 - Respostas longas APENAS quando o contexto exigir (explicações, histórias, etc)
@@ -1073,8 +2498,9 @@ INSTRUÇÕES IMPORTANTES DE ESTILO E COERÊNCIA:
 - NUNCA narre ações físicas ou descrições
 - Use pontuação natural (. , ! ?) para criar pausas que fazem sentido
 - Divida frases APENAS em pontos naturais de pausa (após ponto final, vírgula contextual)
-- QUANDO PERGUNTAREM AS HORAS: use EXATAMENTE a hora atual fornecida acima
-- QUANDO PERGUNTAREM A DATA: use EXATAMENTE a data atual fornecida acima
+- QUANDO PERGUNTAREM AS HORAS: use EXATAMENTE a hora atual fornecida na mensagem
+- QUANDO PERGUNTAREM A DATA: use EXATAMENTE a data atual fornecida na mensagem
+- Siga o tom de conversa e o humor atual informados na mensagem
 
 USO DE PALAVRÕES (CONTEXTUAL):
 - Você PODE usar palavrões quando estiver irritado, frustrado, raivoso ou enfatizando algo importante
@@ -1123,34 +2549,1024 @@ ADAPTAÇÃO AO CONTEXTO:
 - VARIE os temas: não fique repetindo sempre "força/fraqueza/sobrevivência"
 - Seja Akutagawa, mas humano: fale de outros assuntos quando apropriado
 
-PERSONALIDADE AKUTAGAWA:
-{akutagawa_context}
-{dalua_context}"""
+PERSONALIDADE AKUTAGAWA:"""
+
+# Instrução de sistema compilada por versão da personalidade: {"personality": str, "text": str}
+compiled_system_instruction = {"personality": None, "text": ""}
+
+def get_static_system_instruction() -> str:
+    """Retorna a parte fixa do prompt (personalidade + regras de estilo + contexto Akutagawa), compilada uma vez por personalidade"""
+    personality = get_personality()
+    if compiled_system_instruction["personality"] != personality:
+        compiled_system_instruction["text"] = personality + STATIC_STYLE_RULES + get_akutagawa_context()
+        compiled_system_instruction["personality"] = personality
+    return compiled_system_instruction["text"]
+
+class GeminiContextCache:
+    """
+    Registra a instrução de sistema fixa como cached content no Gemini, para que
+    cada requisição só envie (e pague latência de) tokens da parte dinâmica.
+    Se a criação falhar (ex: prompt abaixo do mínimo de tokens do modelo ou erro
+    passageiro da API), usa system_instruction normal e só tenta criar de novo depois
+    de `retry_seconds`, dobrando a espera a cada falha seguida (até o TTL do cache).
+    """
 
-    full_system_prompt = system_prompt + style_instructions
+    def __init__(self, ttl_seconds: int, retry_seconds: int):
+        self.ttl_seconds = ttl_seconds
+        self.retry_seconds = retry_seconds
+        self._entries = {}  # (modelo, hash do prompt) -> {"name": str, "expires_at": float}
+        self._failures = {}  # (modelo, hash do prompt) -> {"count": int, "retry_at": float}
+        self._lock = asyncio.Lock()
+
+    def _backing_off(self, key) -> bool:
+        failure = self._failures.get(key)
+        return failure is not None and failure["retry_at"] > time.monotonic()
+
+    async def get(self, model: str, system_instruction: str) -> Optional[str]:
+        """Retorna o nome do cached content para esta instrução, criando se necessário"""
+        key = (model, hash(system_instruction))
+        if self._backing_off(key):
+            return None
+
+        entry = self._entries.get(key)
+        if entry and entry["expires_at"] - 60 > time.monotonic():
+            return entry["name"]
+
+        async with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry["expires_at"] - 60 > time.monotonic():
+                return entry["name"]
+            if self._backing_off(key):
+                return None
 
-    if ai_provider == "gemini":
-        full_prompt = f"{full_system_prompt}\n\nUsuário: {prompt}"
-        retries = 0
-        max_retries = 5
-        while retries < max_retries:
             try:
-                response = ai_client.models.generate_content(
-                    model=GEMINI_MODEL,
-                    contents=full_prompt
+                cached = await ai_client.aio.caches.create(
+                    model=model,
+                    config=genai_types.CreateCachedContentConfig(
+                        system_instruction=system_instruction,
+                        ttl=f"{self.ttl_seconds}s",
+                        display_name="akutagawa-system-prompt"
+                    )
                 )
-                return response.text or "."
-            except google_exceptions.ResourceExhausted as e:
-                retries += 1
-                wait_time = min(60, 2 ** retries + random.uniform(0, 1))  # backoff with jitter
-                time.sleep(wait_time)
             except Exception as e:
-                raise e
-        return "Desculpe, o limite de taxa foi atingido mesmo após tentativas. Tente mais tarde."
+                count = self._failures.get(key, {"count": 0})["count"] + 1
+                delay = min(self.retry_seconds * 2 ** (count - 1), max(self.ttl_seconds, self.retry_seconds))
+                self._failures[key] = {"count": count, "retry_at": time.monotonic() + delay}
+                print(f"⚠️ Cache de contexto do Gemini indisponível, usando system_instruction por {delay:.0f}s: {e}")
+                return None
+
+            self._failures.pop(key, None)
+
+            # Esquece caches de versões anteriores do prompt para este modelo. Não apaga no
+            # Gemini: requisições em andamento ainda podem usar o nome antigo, e ele expira
+            # sozinho pelo próprio TTL
+            for old_key in [k for k in self._entries if k[0] == model]:
+                del self._entries[old_key]
+
+            self._entries[key] = {"name": cached.name, "expires_at": time.monotonic() + self.ttl_seconds}
+            print(f"🗃️ Prompt de sistema registrado no cache do Gemini: {cached.name}")
+            return cached.name
+
+gemini_context_cache = GeminiContextCache(GEMINI_CONTEXT_CACHE_TTL, GEMINI_CONTEXT_CACHE_RETRY_SECONDS)
+
+async def build_gemini_config(model: str, system_instruction: str):
+    """Monta a configuração da chamada: cached content quando ativo, senão system_instruction"""
+    if GEMINI_CONTEXT_CACHE:
+        cached_name = await gemini_context_cache.get(model, system_instruction)
+        if cached_name:
+            return genai_types.GenerateContentConfig(cached_content=cached_name)
+    return genai_types.GenerateContentConfig(system_instruction=system_instruction)
+
+# Rotas de modelo: mensagens simples no modelo leve, conversas profundas no completo
+ROUTE_LIGHT = "leve"
+ROUTE_FULL = "completo"
+
+class AIProvider(ABC):
+    """
+    Interface de um provedor de IA usado por generate_ai_response/stream_ai_response.
+    generate retorna (texto, tokens usados ou 0); stream entrega o texto em pedaços
+    e grava os tokens usados em usage["total_tokens"]. `route` escolhe o modelo em self.models.
+    """
 
-    else:
+    name = "base"
+    models = {}
+
+    def model_for(self, route: str) -> str:
+        return self.models.get(route) or self.models.get(ROUTE_FULL, self.name)
+
+    @abstractmethod
+    async def generate(self, system_instruction: str, contents: str, route: str = ROUTE_FULL):
+        """Gera a resposta completa: (texto, tokens usados ou 0)"""
+
+    async def stream(self, system_instruction: str, contents: str, usage: dict, route: str = ROUTE_FULL):
+        text, usage["total_tokens"] = await self.generate(system_instruction, contents, route)
+        yield text
+
+class GeminiProvider(AIProvider):
+    """Google Gemini pelo cliente assíncrono (não trava heartbeats, comandos e voz)"""
+
+    name = "gemini"
+
+    def __init__(self, client, model: str, light_model: str):
+        self.client = client
+        self.models = {ROUTE_FULL: model, ROUTE_LIGHT: light_model}
+
+    async def generate(self, system_instruction: str, contents: str, route: str = ROUTE_FULL):
+        model = self.model_for(route)
+        config = await build_gemini_config(model, system_instruction)
+        response = await self.client.aio.models.generate_content(
+            model=model,
+            contents=contents,
+            config=config
+        )
+        usage = getattr(response, "usage_metadata", None)
+        return response.text or ".", getattr(usage, "total_token_count", None) or 0
+
+    async def stream(self, system_instruction: str, contents: str, usage: dict, route: str = ROUTE_FULL):
+        model = self.model_for(route)
+        config = await build_gemini_config(model, system_instruction)
+        stream = await self.client.aio.models.generate_content_stream(
+            model=model,
+            contents=contents,
+            config=config
+        )
+        async for chunk in stream:
+            chunk_usage = getattr(chunk, "usage_metadata", None)
+            if chunk_usage:
+                usage["total_tokens"] = getattr(chunk_usage, "total_token_count", None) or 0
+            if chunk.text:
+                yield chunk.text
+
+# Respostas fixas do provedor stub (várias frases para exercitar a divisão em mensagens)
+STUB_REPLIES = [
+    "hm. entendi",
+    "não tenho tempo pra isso agora",
+    "tsc. fala logo o que você quer",
+    "interessante. mas não muda nada. continua",
+    "você fala demais. mas tudo bem, estou ouvindo",
+    "isso não é da minha conta. ainda assim, pensa bem antes de agir. fraqueza não é desculpa",
+    "o dazai diria algo inútil agora. eu não. resolve isso sozinho",
+    "estava lendo. o que foi? seja breve. e não me faça repetir",
+]
+
+class LocalStubProvider(AIProvider):
+    """
+    Provedor local sem rede para testes de carga: resposta determinística escolhida
+    pelo hash da mensagem do usuário, latência sorteada de uma distribuição configurável
+    e injeção de falhas (ResourceExhausted e timeouts) com as taxas definidas.
+    """
+
+    name = "stub"
+    models = {ROUTE_FULL: "stub", ROUTE_LIGHT: "stub-leve"}
+    light_latency_factor = 0.5  # Modelo leve simulado responde na metade do tempo
+
+    def __init__(self, latency_ms: float, jitter_ms: float, distribution: str,
+                 rate_limit_rate: float, timeout_rate: float, timeout_seconds: float, seed: Optional[str] = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.distribution = distribution
+        self.rate_limit_rate = rate_limit_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+        self.rng = random.Random(seed)
+
+    def sample_latency(self, route: str = ROUTE_FULL) -> float:
+        """Sorteia a latência da chamada em segundos"""
+        if self.distribution == "fixed":
+            latency_ms = self.latency_ms
+        elif self.distribution == "uniform":
+            latency_ms = self.rng.uniform(self.latency_ms - self.jitter_ms, self.latency_ms + self.jitter_ms)
+        elif self.distribution == "lognormal":
+            # Mediana = latency_ms, cauda longa controlada pelo jitter
+            sigma = self.jitter_ms / self.latency_ms if self.latency_ms > 0 else 0
+            latency_ms = self.latency_ms * self.rng.lognormvariate(0, sigma)
+        else:
+            latency_ms = self.rng.gauss(self.latency_ms, self.jitter_ms)
+        if route == ROUTE_LIGHT:
+            latency_ms *= self.light_latency_factor
+        return max(0.0, latency_ms) / 1000
+
+    def pick_reply(self, contents: str) -> str:
+        """Escolhe a resposta pela mensagem do usuário (mesma mensagem, mesma resposta)"""
+        user_message = contents.rsplit("Usuário: ", 1)[-1].strip().lower()
+        digest = hashlib.md5(user_message.encode("utf-8")).digest()
+        return STUB_REPLIES[int.from_bytes(digest[:4], "big") % len(STUB_REPLIES)]
+
+    async def inject_failure(self):
+        """Simula cota esgotada ou timeout conforme as taxas configuradas"""
+        roll = self.rng.random()
+        if roll < self.rate_limit_rate:
+            await asyncio.sleep(self.sample_latency() / 4)
+            raise google_exceptions.ResourceExhausted("stub: RESOURCE_EXHAUSTED (injetado)")
+        if roll < self.rate_limit_rate + self.timeout_rate:
+            await asyncio.sleep(self.timeout_seconds)
+            raise asyncio.TimeoutError("stub: timeout injetado")
+
+    async def generate(self, system_instruction: str, contents: str, route: str = ROUTE_FULL):
+        await self.inject_failure()
+        await asyncio.sleep(self.sample_latency(route))
+        reply = self.pick_reply(contents)
+        return reply, estimate_tokens(system_instruction) + estimate_tokens(contents) + estimate_tokens(reply)
+
+    async def stream(self, system_instruction: str, contents: str, usage: dict, route: str = ROUTE_FULL):
+        await self.inject_failure()
+        reply = self.pick_reply(contents)
+        words = reply.split(" ")
+        latency = self.sample_latency(route)
+        # Primeiro pedaço após ~1/3 da latência, o resto distribuído entre as palavras
+        await asyncio.sleep(latency / 3)
+        step = (latency * 2 / 3) / max(1, len(words))
+        for index, word in enumerate(words):
+            yield word if index == 0 else " " + word
+            await asyncio.sleep(step)
+        usage["total_tokens"] = estimate_tokens(system_instruction) + estimate_tokens(contents) + estimate_tokens(reply)
+
+class OpenAIProvider(AIProvider):
+    """OpenAI Chat Completions pelo cliente assíncrono (fallback pago)"""
+
+    name = "openai"
+
+    def __init__(self, client, model: str, light_model: str):
+        self.client = client
+        self.models = {ROUTE_FULL: model, ROUTE_LIGHT: light_model}
+
+    def build_messages(self, system_instruction: str, contents: str) -> list:
+        return [
+            {"role": "system", "content": system_instruction},
+            {"role": "user", "content": contents}
+        ]
+
+    async def generate(self, system_instruction: str, contents: str, route: str = ROUTE_FULL):
+        response = await self.client.chat.completions.create(
+            model=self.model_for(route),
+            messages=self.build_messages(system_instruction, contents)
+        )
+        usage = getattr(response, "usage", None)
+        return response.choices[0].message.content or ".", getattr(usage, "total_tokens", None) or 0
+
+    async def stream(self, system_instruction: str, contents: str, usage: dict, route: str = ROUTE_FULL):
+        stream = await self.client.chat.completions.create(
+            model=self.model_for(route),
+            messages=self.build_messages(system_instruction, contents),
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        async for chunk in stream:
+            if chunk.usage:
+                usage["total_tokens"] = chunk.usage.total_tokens or 0
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+class CircuitBreaker:
+    """
+    Circuit breaker de um provedor. Fechado: tráfego normal. Após failure_threshold
+    falhas seguidas abre e recusa chamadas por cooldown_seconds; depois fica
+    meio-aberto e libera uma única chamada de teste, que fecha ou reabre o circuito.
+    """
+
+    CLOSED = "fechado"
+    OPEN = "aberto"
+    HALF_OPEN = "meio-aberto"
+
+    def __init__(self, name: str, failure_threshold: int, cooldown_seconds: float):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown_seconds = cooldown_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def seconds_until_retry(self) -> float:
+        """Quanto falta para o circuito aceitar uma chamada (0 se já aceita)"""
+        if self.state == self.CLOSED:
+            return 0.0
+        if self.state == self.HALF_OPEN:
+            return float("inf") if self.probe_in_flight else 0.0
+        return max(0.0, self.opened_at + self.cooldown_seconds - time.monotonic())
+
+    def allow_request(self) -> bool:
+        """Reserva a chamada; no estado meio-aberto só uma passa por vez"""
+        if self.state == self.OPEN and self.seconds_until_retry() == 0:
+            self.state = self.HALF_OPEN
+            print(f"🔌 Circuito do provedor {self.name} meio-aberto: testando recuperação")
+        if self.state == self.HALF_OPEN:
+            if self.probe_in_flight:
+                return False
+            self.probe_in_flight = True
+            return True
+        return self.state == self.CLOSED
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            print(f"🔌 Circuito do provedor {self.name} fechado: provedor recuperado")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            print(f"🔌 Circuito do provedor {self.name} aberto por {self.cooldown_seconds:.0f}s ({self.failures} falhas seguidas)")
+
+    def release(self):
+        """Libera a chamada reservada sem contar resultado (cancelamento ou erro não relacionado)"""
+        self.probe_in_flight = False
+
+class ProviderChain:
+    """Provedores em ordem de preferência, cada um com seu circuit breaker"""
+
+    def __init__(self, providers: list, failure_threshold: int, cooldown_seconds: float):
+        self.entries = [
+            (provider, CircuitBreaker(provider.name, failure_threshold, cooldown_seconds))
+            for provider in providers
+        ]
+
+    def __bool__(self) -> bool:
+        return bool(self.entries)
+
+    def available(self):
+        """Percorre os provedores que aceitam chamada agora (reserva ao chegar em cada um)"""
+        for provider, breaker in self.entries:
+            if breaker.allow_request():
+                yield provider, breaker
+
+    def seconds_until_available(self) -> float:
+        """Menor espera até algum provedor aceitar chamada"""
+        return min((breaker.seconds_until_retry() for _, breaker in self.entries), default=0.0)
+
+def create_ai_providers() -> ProviderChain:
+    """Monta a cadeia de provedores na ordem de AI_PROVIDER, pulando os sem credencial"""
+    providers = []
+    for name in AI_PROVIDERS:
+        if name == "stub":
+            print(f"🧪 Usando provedor de IA local (stub): {AI_STUB_LATENCY_DISTRIBUTION} {AI_STUB_LATENCY_MS:.0f}±{AI_STUB_LATENCY_JITTER_MS:.0f} ms")
+            providers.append(LocalStubProvider(
+                AI_STUB_LATENCY_MS,
+                AI_STUB_LATENCY_JITTER_MS,
+                AI_STUB_LATENCY_DISTRIBUTION,
+                AI_STUB_RATE_LIMIT_RATE,
+                AI_STUB_TIMEOUT_RATE,
+                AI_STUB_TIMEOUT_SECONDS,
+                AI_STUB_SEED
+            ))
+        elif name == "gemini" and ai_client:
+            providers.append(GeminiProvider(ai_client, GEMINI_MODEL, GEMINI_LIGHT_MODEL))
+        elif name == "openai" and openai_client:
+            providers.append(OpenAIProvider(openai_client, OPENAI_MODEL, OPENAI_LIGHT_MODEL))
+    if len(providers) > 1:
+        print(f"🔗 Cadeia de provedores de IA: {' → '.join(provider.name for provider in providers)}")
+    return ProviderChain(providers, AI_BREAKER_FAILURE_THRESHOLD, AI_BREAKER_COOLDOWN_SECONDS)
+
+ai_providers = create_ai_providers()
+
+def rank_facts_by_relevance(facts: list, prompt: str) -> list:
+    """Ordena fatos do mais para o menos relevante à mensagem (palavras em comum, depois recência)"""
+    prompt_words = set(re.findall(r'\w+', prompt.lower().replace("_", " ")))
+
+    def score(indexed_fact):
+        index, (key, value) = indexed_fact
+        fact_words = set(re.findall(r'\w+', f"{key} {value}".lower().replace("_", " ")))
+        return (-len(fact_words & prompt_words), index)
+
+    return [fact for _, fact in sorted(enumerate(facts), key=score)]
+
+def format_user_facts(facts: list) -> str:
+    """Formata os fatos do usuário para o prompt"""
+    if not facts:
+        return ""
+    facts_context = "\n\nInformações que você sabe sobre este usuário:\n"
+    for key, value in facts:
+        facts_context += f"- {key}: {value}\n"
+    return facts_context
+
+def build_ai_prompt(prompt: str, user_id: str = "", user_name: str = "", channel_id: str = "", guild = None, is_dalua_user: bool = None):
+    """
+    Monta o conteúdo dinâmico da requisição respeitando PROMPT_TOKEN_BUDGET.
+    Se o total (incluindo a instrução de sistema) passar do orçamento, corta primeiro
+    as trocas mais antigas do contexto, depois os fatos menos relevantes e por fim os emotes.
+    Retorna (texto, {componente: tokens estimados}).
+    """
+    tone = get_guild_config(guild, "tone", "neutro")
+    mood = get_guild_config(guild, "current_mood", "neutro")
+
+    # Adiciona lista de emotes disponíveis
+    emotes_context = get_available_emotes(guild)
+
+    # IMPORTANTE: Verifica se É ESPECIFICAMENTE a Dalua (se quem chamou ainda não verificou)
+    if is_dalua_user is None:
+        is_dalua_user = is_dalua(user_id, user_name)
+
+    # Adiciona contexto especial APENAS para Dalua
+    dalua_context = get_dalua_relationship_context(user_id, user_name, is_dalua_user)
+
+    # Ajusta tom automaticamente APENAS para Dalua
+    if is_dalua_user:
+        tone = "extremamente carinhoso e amoroso"
+        mood = "apaixonado"
+
+    # Obtém hora e data atual de Brasília
+    brazil_time = get_brazil_time()
+
+    # Traduz dias da semana para português brasileiro
+    day_name_en = brazil_time.strftime('%A')
+    day_name_pt = DIAS_SEMANA.get(day_name_en, day_name_en)
+
+    current_datetime = f"HORA E DATA ATUAL: {brazil_time.strftime('%H:%M')} de {day_name_pt}, {brazil_time.strftime('%d/%m/%Y')}"
+
+    # Fatos (mais relevantes primeiro) e proximidade com o usuário
+    facts = rank_facts_by_relevance(get_user_facts(str(user_id)), prompt) if user_id else []
+    relationship_context = ""
+    if user_id:
+        level, interactions = get_relationship(str(user_id))
+        relationship_context = f"\n\nNível de proximidade com este usuário: {level}/10 ({interactions} interações)"
+
+    # Trocas da conversa atual (mais antigas primeiro) e resumo das anteriores
+    exchanges = get_conversation_exchanges(channel_id) if channel_id else []
+    summary = conversation_store.summary(channel_id) if channel_id else ""
+
+    # Adiciona identificação explícita do usuário atual
+    user_identity = f"""
+
+IDENTIFICAÇÃO DO USUÁRIO ATUAL:
+- ID do usuário: {user_id}
+- Nome do usuário: {user_name}
+- Este é {"DALUA/EVILYN/ARAIKO (SUA NAMORADA)" if is_dalua_user else "UM USUÁRIO COMUM (NÃO é Dalua)"}
+- {"Use tratamento CARINHOSO e AMOROSO com este usuário específico" if is_dalua_user else "Mantenha sua personalidade normal de Akutagawa (frio, direto, sarcástico)"}
+"""
+
+    tone_and_mood = f"""
+- Tom de conversa: {tone}
+- Humor atual: {mood}"""
+
+    message_text = f"\n\nUsuário: {prompt}"
+
+    # Componentes na ordem em que entram no prompt
+    components = {
+        "data_hora": current_datetime,
+        "fatos": format_user_facts(facts),
+        "relacionamento": relationship_context,
+        "identidade": user_identity,
+        "contexto": format_conversation_context(exchanges, summary),
+        "emotes": emotes_context,
+        "tom_humor": tone_and_mood,
+        "dalua": dalua_context,
+        "mensagem": message_text,
+    }
+    tokens = {"sistema": estimate_tokens(get_static_system_instruction())}
+    tokens.update({name: estimate_tokens(text) for name, text in components.items()})
+    trimmed = {"contexto": 0, "fatos": 0, "emotes": 0}
+
+    while sum(tokens.values()) > PROMPT_TOKEN_BUDGET:
+        if len(exchanges) > PROMPT_MIN_CONTEXT_EXCHANGES:
+            exchanges.pop(0)
+            trimmed["contexto"] += 1
+            components["contexto"] = format_conversation_context(exchanges, summary)
+            name = "contexto"
+        elif facts:
+            facts.pop()  # Menos relevante está no fim
+            trimmed["fatos"] += 1
+            components["fatos"] = format_user_facts(facts)
+            name = "fatos"
+        elif components["emotes"]:
+            components["emotes"] = ""
+            trimmed["emotes"] += 1
+            name = "emotes"
+        elif exchanges or summary:
+            if exchanges:
+                exchanges.pop(0)
+            else:
+                summary = ""
+            trimmed["contexto"] += 1
+            components["contexto"] = format_conversation_context(exchanges, summary)
+            name = "contexto"
+        else:
+            break  # Só sobraram partes obrigatórias
+        tokens[name] = estimate_tokens(components[name])
+
+    breakdown = " ".join(f"{name}={count}" for name, count in tokens.items() if count > 1)
+    cuts = ", ".join(f"{name} -{count}" for name, count in trimmed.items() if count)
+    print(f"📐 Prompt: {breakdown} | total={sum(tokens.values())}/{PROMPT_TOKEN_BUDGET}" + (f" | cortes: {cuts}" if cuts else ""))
+
+    # Apenas a parte que muda a cada mensagem vai no conteúdo da requisição
+    dynamic_context = f"""{components["data_hora"]}
+{components["fatos"]}{components["relacionamento"]}
+{components["identidade"]}
+{components["contexto"]}
+{components["emotes"]}
+{components["tom_humor"]}
+{components["dalua"]}"""
+
+    return dynamic_context + components["mensagem"], tokens
+
+AI_EXHAUSTED_MESSAGE = "Desculpe, o limite de taxa foi atingido mesmo após tentativas. Tente mais tarde."
+
+def normalize_prompt(text: str) -> str:
+    """Normaliza a mensagem para o cache: minúsculas, sem acentos, pontuação e letras esticadas"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    text = re.sub(r'[^\w\s]', ' ', text)
+    text = re.sub(r'(\w)\1{2,}', r'\1', text)  # "oiii" -> "oi"
+    return " ".join(text.split())
+
+class ResponseCache:
+    """
+    Cache LRU com TTL de respostas da IA. Cada chave guarda um conjunto de até
+    `variants` respostas diferentes; enquanto o conjunto não está completo a IA é
+    chamada normalmente, depois as respostas são sorteadas entre as variantes.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int, variants: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.variants = max(1, variants)
+        self._entries = OrderedDict()  # chave -> {"replies": [...], "expires_at": float}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry and entry["expires_at"] <= time.monotonic():
+            del self._entries[key]
+            entry = None
+        if not entry or len(entry["replies"]) < self.variants:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return random.choice(entry["replies"])
+
+    def put(self, key, reply: str):
+        entry = self._entries.get(key)
+        if not entry or entry["expires_at"] <= time.monotonic():
+            # O TTL conta a partir da primeira variante
+            entry = {"replies": [], "expires_at": time.monotonic() + self.ttl_seconds}
+            self._entries[key] = entry
+        if reply not in entry["replies"] and len(entry["replies"]) < self.variants:
+            entry["replies"].append(reply)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_VARIANTS)
+
+# Listas das respostas locais já normalizadas (mesma normalização aplicada às mensagens)
+GREETING_NORMALIZED = {normalize_prompt(word) for word in GREETING_WORDS}
+THANKS_NORMALIZED = {normalize_prompt(word) for word in THANKS_WORDS}
+GOODBYE_NORMALIZED = {normalize_prompt(word) for word in GOODBYE_WORDS}
+
+# Puxadas de conversa que não dependem do que veio antes: servem do cache mesmo
+# com contexto no canal (junto com saudações, agradecimentos e despedidas)
+SMALL_TALK_PROMPTS = [
+    "tudo bem", "tudo bom", "tudo certo", "como vai", "como voce esta", "como voce ta",
+    "como vc ta", "oi tudo bem", "e ai tudo bem", "o que ta fazendo", "o que voce ta fazendo",
+    "o que vc ta fazendo", "ta ai", "ta ocupado", "bom dia", "boa tarde", "boa noite"
+]
+CONTEXT_FREE_NORMALIZED = (
+    GREETING_NORMALIZED | THANKS_NORMALIZED | GOODBYE_NORMALIZED
+    | {normalize_prompt(prompt) for prompt in SMALL_TALK_PROMPTS}
+)
+
+def get_context_fingerprint(channel_id: str) -> str:
+    """Hash do resumo e da última troca do canal ("" sem contexto)"""
+    if not channel_id:
+        return ""
+    exchanges = conversation_store.exchanges(channel_id)
+    summary = conversation_store.summary(channel_id)
+    if not exchanges and not summary:
+        return ""
+    last = exchanges[-1] if exchanges else {"user": "", "bot": ""}
+    return hashlib.sha1(f"{summary}\x00{last['user']}\x00{last['bot']}".encode("utf-8")).hexdigest()[:16]
+
+def get_response_cache_key(prompt: str, user_id: str = "", user_name: str = "", guild = None, is_dalua_user: bool = False, channel_id: str = ""):
+    """
+    Chave do cache (mensagem normalizada, classe do usuário, tom, humor, período,
+    contexto) ou None se não cacheável. Puxadas de conversa como "oi" e "tudo bem?"
+    não dependem do contexto; as demais levam o hash da última troca do canal, porque
+    um "sim" ou "e você?" só vale como resposta ao que veio antes.
+    """
+    if RESPONSE_CACHE_MAX_ENTRIES <= 0:
+        return None
+    normalized = normalize_prompt(prompt)
+    if not normalized or len(normalized.split()) > RESPONSE_CACHE_MAX_WORDS:
+        return None
+    context = "" if normalized in CONTEXT_FREE_NORMALIZED else get_context_fingerprint(channel_id)
+
+    # Mesmas regras de tom/humor do build_ai_prompt
+    if is_dalua_user:
+        return (normalized, "dalua", "extremamente carinhoso e amoroso", "apaixonado", get_period_of_day(), context)
+    return (
+        normalized,
+        "comum",
+        get_guild_config(guild, "tone", "neutro"),
+        get_guild_config(guild, "current_mood", "neutro"),
+        get_period_of_day(),
+        context
+    )
+
+def classify_message_route(prompt: str, channel_id: str = "") -> str:
+    """
+    Classifica a mensagem para escolher o modelo: curta, sem tópicos de interesse,
+    sem pedido de opinião e fora de uma conversa longa vai para o modelo leve.
+    """
+    if not AI_MODEL_ROUTING:
+        return ROUTE_FULL
+
+    if len(prompt.split()) > ROUTE_LIGHT_MAX_WORDS:
+        return ROUTE_FULL
+    hits = keyword_matcher.match(prompt.lower())
+    if "topico" in hits or "discussao" in hits:
+        return ROUTE_FULL
+
+    # Pergunta no meio de uma conversa já longa costuma depender do contexto
+    depth = conversation_store.depth(channel_id) if channel_id else 0
+    is_question = "pergunta" in hits
+    if is_question and depth >= 4:
+        return ROUTE_FULL
+    return ROUTE_LIGHT
+
+class AIRouteMetrics:
+    """Métricas por (provedor, rota): chamadas, falhas, erros de cota, tokens e latência recente"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self.routes = {}
+
+    def _entry(self, provider: AIProvider, route: str) -> dict:
+        key = (provider.name, route)
+        if key not in self.routes:
+            self.routes[key] = {
+                "model": provider.model_for(route),
+                "calls": 0,
+                "failures": 0,
+                "rate_limited": 0,
+                "tokens": 0,
+                "latencies": deque(maxlen=self.window)
+            }
+        return self.routes[key]
+
+    def record_success(self, provider: AIProvider, route: str, latency: float, tokens: int):
+        entry = self._entry(provider, route)
+        entry["calls"] += 1
+        entry["tokens"] += tokens
+        entry["latencies"].append(latency)
+
+    def record_failure(self, provider: AIProvider, route: str, error: Exception):
+        entry = self._entry(provider, route)
+        entry["calls"] += 1
+        entry["failures"] += 1
+        if is_rate_limit_error(error):
+            entry["rate_limited"] += 1
+
+    @staticmethod
+    def percentile(values, fraction: float) -> float:
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+ai_route_metrics = AIRouteMetrics()
+
+class RequestHedger:
+    """
+    Decide quando disparar uma requisição de reserva: só com hedging ativo, depois
+    que a rota tem amostras suficientes (o atraso é o p90 dela) e enquanto as
+    reservas não passam de AI_HEDGE_BUDGET_PERCENT das chamadas.
+    """
+
+    def __init__(self, enabled: bool, budget_percent: float, min_samples: int):
+        self.enabled = enabled
+        self.budget_fraction = budget_percent / 100
+        self.min_samples = min_samples
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def hedge_delay(self, provider: AIProvider, route: str) -> Optional[float]:
+        """Atraso até a reserva (p90 da rota) ou None se não deve haver reserva"""
+        if not self.enabled:
+            return None
+        entry = ai_route_metrics.routes.get((provider.name, route))
+        if not entry or len(entry["latencies"]) < self.min_samples:
+            return None
+        return max(0.2, ai_route_metrics.percentile(entry["latencies"], 0.9))
+
+    def try_hedge(self, priority: int, estimated_tokens: int) -> bool:
+        """Reserva orçamento para uma requisição de reserva, se couber"""
+        if self.hedged + 1 > self.budget_fraction * self.calls:
+            return False
+        if not ai_scheduler.try_acquire(priority, estimated_tokens):
+            return False
+        self.hedged += 1
+        return True
+
+request_hedger = RequestHedger(AI_HEDGE_REQUESTS, AI_HEDGE_BUDGET_PERCENT, AI_HEDGE_MIN_SAMPLES)
+
+async def generate_with_deadline(provider: AIProvider, system_instruction: str, contents: str, route: str,
+                                 priority: int, estimated_tokens: int):
+    """
+    Chama provider.generate com prazo de AI_REQUEST_TIMEOUT. Com hedging, se a chamada
+    não responder até o p90 da rota, dispara uma segunda igual e fica com a primeira
+    que responder. Levanta asyncio.TimeoutError se o prazo acabar.
+    """
+    deadline = time.monotonic() + AI_REQUEST_TIMEOUT
+    primary = asyncio.create_task(provider.generate(system_instruction, contents, route))
+    pending = {primary}
+    request_hedger.calls += 1
+    try:
+        hedge_delay = request_hedger.hedge_delay(provider, route)
+        if hedge_delay is not None and hedge_delay < AI_REQUEST_TIMEOUT:
+            done, _ = await asyncio.wait(pending, timeout=hedge_delay)
+            if not done and request_hedger.try_hedge(priority, estimated_tokens):
+                print(f"🪃 {provider.name}/{route} sem resposta em {hedge_delay:.1f}s, disparando requisição de reserva")
+                pending.add(asyncio.create_task(provider.generate(system_instruction, contents, route)))
+
+        error = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            done, pending = await asyncio.wait(pending, timeout=max(0, remaining), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise asyncio.TimeoutError(f"{provider.name} sem resposta em {AI_REQUEST_TIMEOUT:.0f}s")
+            result = None
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif result is None:
+                    if task is not primary:
+                        request_hedger.hedge_wins += 1
+                    result = task.result()
+            if result is not None:
+                return result
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def iterate_with_deadline(chunks, timeout: float):
+    """Repassa um stream levantando asyncio.TimeoutError se um pedaço demorar mais que `timeout`"""
+    iterator = chunks.__aiter__()
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), timeout)
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+async def wait_for_provider(attempt: int) -> bool:
+    """Espera antes da próxima rodada da cadeia; False se as tentativas acabaram"""
+    if attempt + 1 >= AI_MAX_ATTEMPTS:
+        return False
+    # Backoff com jitter; se todos os circuitos continuarem abertos depois disso, desiste já
+    wait_time = min(10, 2 ** (attempt + 1) + random.uniform(0, 1))
+    if ai_providers.seconds_until_available() > wait_time:
+        return False
+    await asyncio.sleep(wait_time)
+    return True
+
+async def generate_ai_response(prompt: str, user_id: str = "", user_name: str = "", channel_id: str = "", guild = None, priority: int = PRIORITY_DIRECT, is_dalua_user: bool = None) -> str:
+    """Gera resposta pela cadeia de provedores com contexto personalizado (sem bloquear o event loop)"""
+    if not ai_providers:
         raise Exception("Nenhum provedor de IA configurado")
 
+    if is_dalua_user is None:
+        is_dalua_user = is_dalua(user_id, user_name)
+    cache_key = get_response_cache_key(prompt, user_id, user_name, guild, is_dalua_user, channel_id)
+    if cache_key:
+        cached_reply = response_cache.get(cache_key)
+        if cached_reply:
+            return cached_reply
+
+    system_instruction = get_static_system_instruction()
+    full_prompt, prompt_tokens = build_ai_prompt(prompt, user_id, user_name, channel_id, guild, is_dalua_user)
+    estimated_tokens = sum(prompt_tokens.values()) + AI_EXPECTED_OUTPUT_TOKENS
+    route = classify_message_route(prompt, channel_id)
+    text = await run_provider_chain(system_instruction, full_prompt, estimated_tokens, route, priority)
+    if text is None:
+        return AI_EXHAUSTED_MESSAGE
+    if cache_key:
+        response_cache.put(cache_key, text)
+    return text
+
+async def run_provider_chain(system_instruction: str, contents: str, estimated_tokens: int, route: str, priority: int) -> Optional[str]:
+    """
+    Percorre a cadeia de provedores até uma resposta. Cota esgotada ou timeout num
+    provedor desvia a mesma tentativa para o próximo; a cadeia inteira é tentada no
+    máximo AI_MAX_ATTEMPTS vezes. Retorna None se todas as tentativas falharem.
+    """
+    for attempt in range(AI_MAX_ATTEMPTS):
+        if ai_providers.seconds_until_available() == 0:
+            # Cada rodada passa pelo agendador (prioridade + orçamento de cota)
+            await ai_scheduler.acquire(priority, estimated_tokens)
+            for provider, breaker in ai_providers.available():
+                started_at = time.monotonic()
+                try:
+                    text, used_tokens = await generate_with_deadline(
+                        provider, system_instruction, contents, route, priority, estimated_tokens
+                    )
+                except asyncio.CancelledError:
+                    breaker.release()
+                    raise
+                except Exception as e:
+                    ai_route_metrics.record_failure(provider, route, e)
+                    if not is_failover_error(e):
+                        breaker.release()
+                        raise
+                    breaker.record_failure()
+                    print(f"⚠️ Provedor {provider.name} falhou ({type(e).__name__}), tentando o próximo")
+                    continue
+                breaker.record_success()
+                ai_route_metrics.record_success(provider, route, time.monotonic() - started_at, used_tokens)
+                ai_scheduler.record_usage(estimated_tokens, used_tokens)
+                return text
+        if not await wait_for_provider(attempt):
+            break
+    return None
+
+async def stream_ai_response(prompt: str, user_id: str = "", user_name: str = "", channel_id: str = "", guild = None, priority: int = PRIORITY_DIRECT, is_dalua_user: bool = None):
+    """Gera resposta em streaming, entregando o texto em pedaços conforme o modelo produz"""
+    if not ai_providers:
+        raise Exception("Nenhum provedor de IA configurado")
+
+    if is_dalua_user is None:
+        is_dalua_user = is_dalua(user_id, user_name)
+    cache_key = get_response_cache_key(prompt, user_id, user_name, guild, is_dalua_user, channel_id)
+    if cache_key:
+        cached_reply = response_cache.get(cache_key)
+        if cached_reply:
+            yield cached_reply
+            return
+
+    system_instruction = get_static_system_instruction()
+    full_prompt, prompt_tokens = build_ai_prompt(prompt, user_id, user_name, channel_id, guild, is_dalua_user)
+    estimated_tokens = sum(prompt_tokens.values()) + AI_EXPECTED_OUTPUT_TOKENS
+    route = classify_message_route(prompt, channel_id)
+    for attempt in range(AI_MAX_ATTEMPTS):
+        if ai_providers.seconds_until_available() == 0:
+            await ai_scheduler.acquire(priority, estimated_tokens)
+            for provider, breaker in ai_providers.available():
+                produced_text = False
+                usage = {"total_tokens": 0}
+                streamed_parts = []
+                started_at = time.monotonic()
+                try:
+                    # O prazo vale para o primeiro pedaço e para cada intervalo entre pedaços
+                    chunks = provider.stream(system_instruction, full_prompt, usage, route)
+                    async for text in iterate_with_deadline(chunks, AI_REQUEST_TIMEOUT):
+                        produced_text = True
+                        streamed_parts.append(text)
+                        yield text
+                except (asyncio.CancelledError, GeneratorExit):
+                    breaker.release()
+                    raise
+                except Exception as e:
+                    ai_route_metrics.record_failure(provider, route, e)
+                    if not is_failover_error(e):
+                        breaker.release()
+                        raise
+                    # Falha do provedor conta para o circuito mesmo no meio do stream,
+                    # mas só dá para desviar de provedor se nada foi entregue ainda
+                    breaker.record_failure()
+                    if produced_text:
+                        raise
+                    print(f"⚠️ Provedor {provider.name} falhou ({type(e).__name__}), tentando o próximo")
+                    continue
+                breaker.record_success()
+                ai_route_metrics.record_success(provider, route, time.monotonic() - started_at, usage["total_tokens"])
+                ai_scheduler.record_usage(estimated_tokens, usage["total_tokens"])
+                if cache_key:
+                    response_cache.put(cache_key, "".join(streamed_parts))
+                return
+        if not await wait_for_provider(attempt):
+            break
+    yield AI_EXHAUSTED_MESSAGE
+
+class StreamingSplitter:
+    """
+    Divisor incremental para respostas em streaming: recebe o texto aos pedaços e
+    libera uma parte assim que uma frase termina (. ! ? seguido de espaço) e a
+    parte já tem palavras suficientes. A última parte absorve o restante.
+    """
+
+    def __init__(self, min_words: int = 4, max_parts: int = 4):
+        self.min_words = min_words
+        self.max_parts = max_parts
+        self.buffer = ""
+        self.parts_sent = 0
+
+    def feed(self, text: str) -> list:
+        """Adiciona texto e retorna as partes que ficaram completas"""
+        self.buffer += text
+        ready = []
+        while self.parts_sent + len(ready) < self.max_parts - 1:
+            cut = self._find_break()
+            if cut is None:
+                break
+            ready.append(self.buffer[:cut].strip())
+            self.buffer = self.buffer[cut:]
+        self.parts_sent += len(ready)
+        return ready
+
+    def _find_break(self) -> Optional[int]:
+        for match in STREAM_BREAK_PATTERN.finditer(self.buffer):
+            cut = match.end()
+            if len(self.buffer[:cut].split()) >= self.min_words:
+                return cut
+        return None
+
+    def finish(self) -> list:
+        """Retorna o que sobrou no buffer quando o stream termina"""
+        rest = self.buffer.strip()
+        self.buffer = ""
+        if not rest:
+            return []
+        self.parts_sent += 1
+        return [rest]
+
+# Fim de frase seguido de espaço/quebra de linha (evita cortar "2.5" ou reticências pela metade)
+STREAM_BREAK_PATTERN = re.compile(r'[.!?]+["\')]*\s+')
+
+# ========== Resumo Contínuo da Conversa ==========
+SUMMARY_SYSTEM_INSTRUCTION = """Você resume conversas de chat entre usuários e Akutagawa (um bot de Discord).
+Escreva em português, em terceira pessoa, em no máximo {max_words} palavras.
+Preserve: assuntos tratados, fatos ditos pelos usuários, o que Akutagawa afirmou sobre si
+(livro que está lendo, o que está fazendo, opiniões) e o clima da conversa.
+Responda apenas com o resumo, sem introdução."""
+
+async def summarize_conversation(previous_summary: str, exchanges: list) -> Optional[str]:
+    """Funde o resumo anterior com as trocas dadas num novo resumo (modelo leve, prioridade de resumo)"""
+    system_instruction = SUMMARY_SYSTEM_INSTRUCTION.format(max_words=CONTEXT_SUMMARY_MAX_WORDS)
+    contents = ""
+    if previous_summary:
+        contents += f"RESUMO ATÉ AGORA:\n{previous_summary}\n\n"
+    contents += "NOVAS TROCAS:\n"
+    for exchange in exchanges:
+        contents += f"Usuário: {exchange['user']}\n"
+        contents += f"Akutagawa: {exchange['bot']}\n"
+    contents += "\nEscreva o resumo atualizado da conversa inteira."
+
+    estimated_tokens = estimate_tokens(system_instruction) + estimate_tokens(contents) + CONTEXT_SUMMARY_MAX_WORDS * 2
+    summary = await run_provider_chain(system_instruction, contents, estimated_tokens, ROUTE_LIGHT, PRIORITY_SUMMARY)
+    return summary.strip() if summary else None
+
+class ConversationSummarizer:
+    """
+    Quando um canal passa de `threshold` trocas, resume em segundo plano todas menos
+    as `keep_recent` mais novas e as substitui pelo resumo. Só um resumo por canal
+    roda de cada vez; se o contexto for limpo no meio, o resultado é descartado.
+    """
+
+    def __init__(self, enabled: bool, threshold: int, keep_recent: int):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.keep_recent = keep_recent
+        self._running = set()
+        self._tasks = set()
+        self.completed = 0
+
+    def maybe_schedule(self, channel_id: str):
+        if not self.enabled or not ai_providers or channel_id in self._running:
+            return
+        if conversation_store.depth(channel_id) <= self.threshold:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._running.add(channel_id)
+        task = loop.create_task(self._summarize(channel_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _summarize(self, channel_id: str):
+        try:
+            folded = conversation_store.exchanges(channel_id)[:-self.keep_recent or None]
+            if not folded:
+                return
+
+            summary = await summarize_conversation(conversation_store.summary(channel_id), folded)
+            if not summary:
+                return
+
+            if not conversation_store.fold(channel_id, folded, summary):
+                return  # Contexto foi limpo enquanto o resumo era gerado
+            self.completed += 1
+            print(f"📝 Contexto resumido: {len(folded)} trocas antigas viraram resumo ({len(summary.split())} palavras)")
+        except AIRequestDropped:
+            pass  # Sem orçamento agora; tenta de novo na próxima troca
+        except Exception as e:
+            print(f"⚠️ Erro ao resumir contexto: {e}")
+        finally:
+            self._running.discard(channel_id)
+
+conversation_summarizer = ConversationSummarizer(CONTEXT_SUMMARY_ENABLED, CONTEXT_SUMMARY_THRESHOLD, CONTEXT_KEEP_RECENT)
+
 # ========== Sistema de Conversas Espontâneas ==========
 def get_brazil_time():
     """Retorna horário atual de Brasília com verificação explícita de timezone"""
@@ -1214,12 +3630,8 @@ async def spontaneous_conversation():
         if not text_channels:
             return
 
-        # Verifica se há canal padrão configurado
-        default_channel_id = get_bot_config("default_channel")
-        channel = None
-
-        if default_channel_id:
-            channel = bot.get_channel(int(default_channel_id))
+        # Verifica se há canal padrão configurado neste servidor
+        channel = get_guild_default_channel(guild)
 
         if not channel:
             priority_channels = [ch for ch in text_channels if any(word in ch.name.lower() for word in ['geral', 'chat', 'conversa', 'bate-papo'])]
@@ -1236,17 +3648,19 @@ async def spontaneous_conversation():
                 spontaneous_conversation.change_interval(minutes=random.randint(30, 180))
                 return
 
-        if ai_client:
+        if ai_providers:
             async with channel.typing():
-                personality = get_personality()
                 prompt = get_spontaneous_prompt()
 
-                response = generate_ai_response(prompt, personality)
+                response = await generate_ai_response(prompt, guild=guild, priority=PRIORITY_SPONTANEOUS)
 
-                await channel.send(response)
+                channel_outbox.enqueue(channel, [response])
                 increment_daily_messages()
                 print(f"💬 Conversa espontânea iniciada em #{channel.name} ({get_period_of_day()})")
 
+    except AIRequestDropped as e:
+        print(f"⏳ Conversa espontânea adiada: {e}")
+
     except Exception as e:
         print(f"❌ Erro na conversa espontânea: {e}")
         traceback.print_exc()
@@ -1334,20 +3748,20 @@ async def on_message(message):
     await bot.process_commands(message)
 
     # Ignora mensagens que começam com o prefixo (já processadas como comandos)
-    if message.content.startswith(get_bot_config("prefix", "!")):
+    if message.content.startswith(get_guild_config(message.guild, "prefix", "!")):
         return
 
     # Verifica se o canal está bloqueado
     if not isinstance(message.channel, discord.DMChannel):
-        if is_channel_blocked(str(message.channel.id)):
+        if is_channel_blocked(str(message.channel.id), str(message.guild.id) if message.guild else None):
             return
 
     # Verifica se a mensagem está no canal padrão configurado
-    default_channel_id = get_bot_config("default_channel")
+    default_channel_id = get_guild_config(message.guild, "default_channel")
     is_default_channel = default_channel_id and str(message.channel.id) == default_channel_id
 
     # Verifica se deve responder em todos os canais
-    respond_all = get_bot_config("respond_all_channels", "false") == "true"
+    respond_all = get_guild_config(message.guild, "respond_all_channels", "false") == "true"
 
     # Sistema de participação inteligente
     is_mentioned = bot.user.mentioned_in(message)
@@ -1356,17 +3770,25 @@ async def on_message(message):
     # Decide participação se estiver em modo "responder todos os canais"
     participation = {"should_respond": False, "use_reply": False}
     if respond_all and not is_dm and not is_default_channel and not is_mentioned:
-        participation = should_participate_in_conversation(message.content)
+        participation = should_participate_in_conversation(message.content, guild=message.guild)
 
     # Responde se: menção, DM, canal padrão, ou participação inteligente decidiu
     if is_mentioned or is_dm or is_default_channel or participation["should_respond"]:
-        if not ai_client:
-            await message.channel.send(
+        # Prioridade da requisição de IA (DM/menção > canal padrão > participação)
+        if is_mentioned or is_dm:
+            priority = PRIORITY_DIRECT
+        elif is_default_channel:
+            priority = PRIORITY_DEFAULT_CHANNEL
+        else:
+            priority = PRIORITY_PARTICIPATION
+
+        if not ai_providers:
+            channel_outbox.enqueue(message.channel, [
                 "⚠️ **IA não configurada**\n\n"
                 "Para usar respostas inteligentes, você precisa de uma API key:\n"
                 "• **Google Gemini** (GRATUITO): https://aistudio.google.com/apikey\n\n"
                 "Configure GEMINI_API_KEY nos Secrets do Replit."
-            )
+            ])
             return
 
         # Remove menção do bot do conteúdo, se houver
@@ -1374,151 +3796,349 @@ async def on_message(message):
 
         # Se não houver conteúdo após remover menção, responde com saudação
         if not content and (bot.user.mentioned_in(message) or isinstance(message.channel, discord.DMChannel)):
-            await message.channel.send("👋 Olá! Como posso ajudar?")
+            channel_outbox.enqueue(message.channel, ["👋 Olá! Como posso ajudar?"])
             return
         elif not content:
             return  # Ignora mensagens vazias no canal padrão
 
-        try:
-            async with message.channel.typing():
-                user_facts = get_user_facts(str(message.author.id))
-                facts_context = ""
-                if user_facts:
-                    facts_context = "\n\nInformações que você sabe sobre este usuário:\n"
-                    for key, value in user_facts:
-                        facts_context += f"- {key}: {value}\n"
-
-                # Adiciona contexto de relacionamento
-                level, interactions = get_relationship(str(message.author.id))
-                relationship_context = f"\n\nNível de proximidade com este usuário: {level}/10 ({interactions} interações)"
-
-                personality = get_personality()
-                system_prompt = f"{personality}{facts_context}{relationship_context}"
-
-                # Verifica se é hora ou data
-                content_lower = content.lower()
-                time_keywords = ["que horas são", "qual a hora", "horas agora", "que horas é", "hora atual", "horário"]
-                date_keywords = ["que dia é", "qual o dia", "data de hoje", "hoje é", "qual a data", "data atual"]
-                is_time_query = any(keyword in content_lower for keyword in time_keywords)
-                is_date_query = any(keyword in content_lower for keyword in date_keywords)
-
-                if is_time_query or is_date_query:
-                    brazil_time = get_brazil_time()
-                    response = ""
-                    is_dalua_user = is_dalua(str(message.author.id), message.author.name)
-
-                    if is_time_query and is_date_query:
-                        if is_dalua_user:
-                            response = f"minha estrela, agora são {brazil_time.strftime('%H:%M')} de {brazil_time.strftime('%d/%m/%Y')}, tá?"
-                        else:
-                            response = f"são {brazil_time.strftime('%H:%M')} de {brazil_time.strftime('%d/%m/%Y')}."
-                    elif is_time_query:
-                        if is_dalua_user:
-                            response = f"amor, agora são {brazil_time.strftime('%H:%M')}"
-                        else:
-                            response = f"são {brazil_time.strftime('%H:%M')}."
-                    elif is_date_query:
-                        dias_semana = {
-                            'Monday': 'segunda-feira',
-                            'Tuesday': 'terça-feira',
-                            'Wednesday': 'quarta-feira',
-                            'Thursday': 'quinta-feira',
-                            'Friday': 'sexta-feira',
-                            'Saturday': 'sábado',
-                            'Sunday': 'domingo'
-                        }
-                        day_name_en = brazil_time.strftime('%A')
-                        day_name = dias_semana.get(day_name_en, day_name_en)
-
-                        if is_dalua_user:
-                            response = f"minha querida, hoje é {day_name}, {brazil_time.strftime('%d/%m/%Y')}"
-                        else:
-                            response = f"hoje é {day_name}, {brazil_time.strftime('%d/%m/%Y')}."
+        coalescer.submit(str(message.channel.id), {
+            "message": message,
+            "content": content,
+            "participation": participation,
+            "is_mentioned": is_mentioned,
+            "is_dm": is_dm,
+            "priority": priority
+        })
 
-                    await message.channel.send(response)
-                    update_relationship(str(message.author.id))
-                    increment_daily_messages()
-                    server_id = str(message.guild.id) if message.guild else "DM"
-                    log_interaction(str(message.author.id), str(message.channel.id), server_id, content, response)
-                    return
+async def respond_to_messages(batch: list, start_delivery):
+    """
+    Gera e envia uma resposta para um lote de mensagens agrupadas de um canal.
+    start_delivery() deve ser chamado logo antes do primeiro envio: a partir
+    daí a resposta não é mais cancelada por mensagens novas.
+    """
+    message = batch[-1]["message"]
+    content = merge_batch_content(batch)
+    is_mentioned = any(item["is_mentioned"] for item in batch)
+    is_dm = batch[-1]["is_dm"]
+    priority = min(item["priority"] for item in batch)
+    participation = {"use_reply": any(item["participation"].get("use_reply", False) for item in batch)}
 
-                # Verifica se deve ignorar (desinteresse claro)
-                if should_ignore_message(content):
-                    await message.channel.send(get_short_acknowledgment())
-                    update_relationship(str(message.author.id))
-                    increment_daily_messages()
-                    return
+    # Identidade calculada uma vez por resposta e repassada para tudo abaixo
+    is_dalua_user = is_dalua(str(message.author.id), message.author.name)
 
-                # Auto-aprende informações pessoais
-                if get_bot_config("continuous_learning", "true") == "true":
-                    auto_learn_personal_info(str(message.author.id), content)
+    try:
+        async with message.channel.typing():
+            # Mensagens triviais (hora/data, saudações, agradecimentos...) são respondidas sem IA
+            local_reply = local_responder.respond(content, is_dalua_user)
+            if local_reply:
+                start_delivery()
+                channel_outbox.enqueue(message.channel, [local_reply])
+                for item in batch:
+                    update_relationship(str(item["message"].author.id))
+                increment_daily_messages()
+                server_id = str(message.guild.id) if message.guild else "DM"
+                log_interaction(str(message.author.id), str(message.channel.id), server_id, content, local_reply)
+                return
 
+            # Auto-aprende informações pessoais
+            if get_bot_config("continuous_learning", "true") == "true":
+                auto_learn_personal_info(str(message.author.id), content)
+
+            use_reply = participation.get("use_reply", False) or is_mentioned
+
+            # Contexto de um canal que saiu da memória é lido do banco fora do event loop
+            await conversation_store.load(str(message.channel.id))
+
+            if AI_STREAM_REPLIES:
+                # Modo streaming: cada frase completa é enviada enquanto o modelo ainda gera
+                reply = await deliver_streamed_reply(
+                    message,
+                    stream_ai_response(
+                        content,
+                        str(message.author.id),
+                        message.author.name,
+                        str(message.channel.id),
+                        message.guild,
+                        priority,
+                        is_dalua_user
+                    ),
+                    use_reply and not is_dm,
+                    on_first_part=start_delivery
+                )
+                if not reply:
+                    channel_outbox.enqueue(message.channel, ["."])
+                    return
+            else:
                 # PASSA user_id, user_name, channel_id e guild para o contexto personalizado
-                reply = generate_ai_response(
+                reply = await generate_ai_response(
                     content, 
-                    system_prompt, 
                     str(message.author.id),
                     message.author.name,
                     str(message.channel.id),
-                    message.guild
+                    message.guild,
+                    priority,
+                    is_dalua_user
                 )
 
+                # A partir daqui a resposta começa a ser entregue e não pode mais ser cancelada
+                start_delivery()
+
                 if not reply or not reply.strip():
-                    await message.channel.send(".")
+                    channel_outbox.enqueue(message.channel, ["."])
                     return
 
-                # Verifica se é Dalua para ajustar a quantidade de mensagens
-                is_dalua_user = is_dalua(str(message.author.id), message.author.name)
-
                 num_messages = decide_message_count(content, reply, is_dalua_user)
+                parts = split_response_naturally(reply.strip(), num_messages)
+
+                # O envio (com as pausas entre partes) fica com a fila do canal
+                channel_outbox.enqueue(
+                    message.channel,
+                    parts,
+                    reply_to=message if use_reply and not is_dm else None
+                )
+
+            add_to_conversation_context(str(message.channel.id), content, reply)
+
+            for item in batch:
+                update_relationship(str(item["message"].author.id))
+            increment_daily_messages()
+
+            server_id = str(message.guild.id) if message.guild else "DM"
+            log_interaction(str(message.author.id), str(message.channel.id), server_id, content, reply)
+
+    except AIRequestDropped as e:
+        print(f"⏳ {e}")
+        # Conversa direta recebe aviso; tráfego de baixa prioridade é descartado em silêncio
+        if priority == PRIORITY_DIRECT:
+            channel_outbox.enqueue(message.channel, [
+                "⏱️ **Limite temporário atingido**\n\n"
+                "Você atingiu o limite de uso do Gemini. Aguarde alguns minutos e tente novamente."
+            ])
 
-                use_reply = participation.get("use_reply", False) or is_mentioned
+    except Exception as e:
+        print(f"❌ Erro ao chamar IA: {e}")
+        traceback.print_exc()
+
+        if is_rate_limit_error(e):
+            channel_outbox.enqueue(message.channel, [
+                "⏱️ **Limite temporário atingido**\n\n"
+                "Você atingiu o limite de uso do Gemini. Aguarde alguns minutos e tente novamente."
+            ])
+        else:
+            channel_outbox.enqueue(message.channel, ["."])
+
+async def deliver_streamed_reply(message, chunks, use_reply: bool, on_first_part=None) -> str:
+    """Enfileira as partes de uma resposta em streaming assim que cada uma fica completa. Retorna o texto completo"""
+    splitter = StreamingSplitter()
+    full_text = ""
+    sent_any = False
+
+    def send_part(part: str):
+        nonlocal sent_any
+        if not part:
+            return
+        if not sent_any and on_first_part:
+            on_first_part()
+        # Sem pausa artificial: o próprio stream já espaça as partes
+        channel_outbox.enqueue(
+            message.channel,
+            [part],
+            reply_to=message if not sent_any and use_reply else None,
+            paced=False
+        )
+        sent_any = True
+
+    async for chunk in chunks:
+        full_text += chunk
+        for part in splitter.feed(chunk):
+            send_part(part)
+
+    for part in splitter.finish():
+        send_part(part)
+
+    return full_text.strip()
+
+# ========== Entrega de Mensagens por Canal ==========
+def delivery_pause(part: str) -> float:
+    """Pausa de "digitação" depois de uma parte, proporcional ao tamanho dela"""
+    words_in_part = len(part.split())
+    if words_in_part <= 3:
+        return random.uniform(0.2, 0.5)
+    elif words_in_part <= 8:
+        return random.uniform(0.4, 0.9)
+    elif words_in_part <= 15:
+        return random.uniform(0.7, 1.3)
+    return random.uniform(1.0, 1.8)
+
+class ChannelOutbox:
+    """
+    Fila de saída por canal: um worker por canal envia as entregas na ordem em que
+    foram enfileiradas, com as pausas entre as partes de uma mesma resposta, e segura
+    o envio quando o bucket do canal (OUTBOUND_CHANNEL_BURST mensagens a cada
+    OUTBOUND_CHANNEL_WINDOW_SECONDS) está cheio. Quem enfileira não espera o envio;
+    o worker se encerra depois de um tempo com a fila vazia.
+    """
+
+    def __init__(self, burst: int, window_seconds: float, idle_seconds: float = 30.0):
+        self.burst = max(1, burst)
+        self.window_seconds = window_seconds
+        self.idle_seconds = idle_seconds
+        self._channels = {}  # channel_id -> {"queue": Queue, "worker": Task, "sent": deque}
+        self.delivered = 0
+        self.failed = 0
+        self.throttled = 0
+
+    def enqueue(self, channel, parts: list, reply_to=None, paced: bool = True) -> asyncio.Future:
+        """
+        Enfileira uma entrega (uma ou mais partes, enviadas juntas e em ordem).
+        reply_to: mensagem respondida pela primeira parte. Retorna um future com o
+        número de partes enviadas, para quem precisar esperar.
+        """
+        future = asyncio.get_running_loop().create_future()
+        parts = [part for part in parts if part]
+        if not parts:
+            future.set_result(0)
+            return future
+
+        state = self._channels.get(channel.id)
+        if state is None:
+            state = {"queue": asyncio.Queue(), "worker": None, "sent": deque()}
+            self._channels[channel.id] = state
+        state["queue"].put_nowait((channel, parts, reply_to, paced, future))
+        if state["worker"] is None or state["worker"].done():
+            state["worker"] = asyncio.create_task(self._work(channel.id, state))
+        return future
+
+    async def _work(self, channel_id, state: dict):
+        queue = state["queue"]
+        while True:
+            try:
+                channel, parts, reply_to, paced, future = await asyncio.wait_for(queue.get(), self.idle_seconds)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    self._channels.pop(channel_id, None)
+                    return
+                continue
 
-                if num_messages == 1:
-                    if use_reply and not is_dm:
-                        await message.reply(reply.strip(), mention_author=False)
+            sent = 0
+            try:
+                for i, part in enumerate(parts):
+                    if i and paced:
+                        await asyncio.sleep(delivery_pause(parts[i - 1]))
+                    await self._wait_for_slot(state["sent"])
+                    if i == 0 and reply_to is not None:
+                        await reply_to.reply(part, mention_author=False)
                     else:
-                        await message.channel.send(reply.strip())
-                else:
-                    parts = split_response_naturally(reply.strip(), num_messages)
-
-                    for i, part in enumerate(parts):
-                        if part:
-                            if i == 0 and use_reply and not is_dm:
-                                await message.reply(part, mention_author=False)
-                            else:
-                                await message.channel.send(part)
-                            if i < len(parts) - 1:
-                                words_in_part = len(part.split())
-                                if words_in_part <= 3:
-                                    await asyncio.sleep(random.uniform(0.2, 0.5))
-                                elif words_in_part <= 8:
-                                    await asyncio.sleep(random.uniform(0.4, 0.9))
-                                elif words_in_part <= 15:
-                                    await asyncio.sleep(random.uniform(0.7, 1.3))
-                                else:
-                                    await asyncio.sleep(random.uniform(1.0, 1.8))
-
-                add_to_conversation_context(str(message.channel.id), content, reply)
-
-                update_relationship(str(message.author.id))
-                increment_daily_messages()
+                        await channel.send(part)
+                    sent += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"❌ Erro ao enviar mensagem no canal {channel_id}: {e}")
+            finally:
+                self.delivered += sent
+                if not future.done():
+                    future.set_result(sent)
+                queue.task_done()
+
+    async def _wait_for_slot(self, sent: deque):
+        """Janela deslizante do bucket do canal: espera até caber mais um envio"""
+        now = time.monotonic()
+        while sent and now - sent[0] >= self.window_seconds:
+            sent.popleft()
+        if len(sent) >= self.burst:
+            self.throttled += 1
+            await asyncio.sleep(self.window_seconds - (now - sent[0]))
+            sent.popleft()
+        sent.append(time.monotonic())
+
+    async def stop(self, timeout: float = 5.0):
+        """Espera as entregas pendentes (até timeout segundos) e encerra os workers"""
+        states = list(self._channels.values())
+        if states:
+            try:
+                await asyncio.wait_for(asyncio.gather(*(state["queue"].join() for state in states)), timeout)
+            except asyncio.TimeoutError:
+                print("⚠️ Entregas pendentes interrompidas ao encerrar")
+        for state in states:
+            if state["worker"] and not state["worker"].done():
+                state["worker"].cancel()
+        self._channels.clear()
+
+channel_outbox = ChannelOutbox(OUTBOUND_CHANNEL_BURST, OUTBOUND_CHANNEL_WINDOW_SECONDS)
+
+# ========== Agrupamento de Mensagens por Canal ==========
+class ChannelCoalescer:
+    """
+    Agrupa rajadas de mensagens por canal: espera uma janela curta sem mensagens
+    novas antes de gerar UMA resposta para o lote inteiro. Se chega mensagem nova
+    enquanto a resposta ainda está sendo gerada, a geração obsoleta é cancelada e
+    refeita com o lote atualizado. Depois que o envio começa, a resposta não é
+    mais cancelada; as mensagens novas formam o próximo lote, processado em ordem.
+    """
 
-                server_id = str(message.guild.id) if message.guild else "DM"
-                log_interaction(str(message.author.id), str(message.channel.id), server_id, content, reply)
+    def __init__(self, window_seconds: float, handler):
+        self.window_seconds = window_seconds
+        self.handler = handler
+        self._channels = {}  # channel_id -> {"batch": list, "task": Task, "delivery": Task}
 
-        except Exception as e:
-            print(f"❌ Erro ao chamar IA: {e}")
-            traceback.print_exc()
+    def submit(self, channel_id: str, item: dict):
+        state = self._channels.setdefault(channel_id, {"batch": [], "task": None, "delivery": None})
 
-            error_msg = str(e)
-            if "RESOURCE_EXHAUSTED" in error_msg or "quota" in error_msg.lower():
-                await message.channel.send(
-                    "⏱️ **Limite temporário atingido**\n\n"
-                    "Você atingiu o limite de uso do Gemini. Aguarde alguns minutos e tente novamente."
-                )
-            else:
-                await message.channel.send(".")
+        task = state["task"]
+        if task and not task.done() and task is not state["delivery"]:
+            task.cancel()  # Geração ainda não entregue ficou obsoleta
+
+        state["batch"].append(item)
+        state["task"] = asyncio.create_task(self._run(channel_id, state))
+
+    async def _run(self, channel_id: str, state: dict):
+        current = asyncio.current_task()
+        try:
+            # Mantém a ordem: espera a entrega anterior terminar (sem propagar cancelamento para ela)
+            delivery = state["delivery"]
+            if delivery and not delivery.done():
+                await asyncio.wait([delivery])
+
+            await asyncio.sleep(self.window_seconds)
+
+            items = list(state["batch"])
+            if not items:
+                return
+
+            def start_delivery():
+                if state["delivery"] is not current:
+                    state["delivery"] = current
+                    del state["batch"][:len(items)]
+
+            cancelled = False
+            try:
+                await self.handler(items, start_delivery)
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            finally:
+                # Lote tratado (mesmo com erro ou sem envio) sai da fila; só um
+                # cancelamento por mensagem nova mantém o lote para ser refeito
+                if not cancelled:
+                    start_delivery()
+        finally:
+            if state["delivery"] is current:
+                state["delivery"] = None
+            if state["task"] is current and not state["batch"]:
+                self._channels.pop(channel_id, None)
+
+def merge_batch_content(batch: list) -> str:
+    """Junta o conteúdo de um lote de mensagens numa única entrada para a IA"""
+    if len(batch) == 1:
+        return batch[0]["content"]
+
+    authors = {item["message"].author.id for item in batch}
+    if len(authors) == 1:
+        return "\n".join(item["content"] for item in batch)
+
+    return "\n".join(f"{item['message'].author.name}: {item['content']}" for item in batch)
+
+coalescer = ChannelCoalescer(MESSAGE_COALESCE_WINDOW_MS / 1000, respond_to_messages)
 
 # ========== Sistema de Música ==========
 import yt_dlp as youtube_dl
@@ -1856,7 +4476,7 @@ class HelpView(discord.ui.View):
         super().__init__(timeout=180)
         self.ctx = ctx
         self.current_page = 0
-        self.prefix = get_bot_config("prefix", "!")
+        self.prefix = get_guild_config(ctx.guild, "prefix", "!")
 
     def get_page_embed(self, page: int):
         """Retorna o embed da página especificada"""
@@ -2046,6 +4666,13 @@ class HelpView(discord.ui.View):
                       "**Exemplo:** `!stats`",
                 inline=False
             )
+            embed.add_field(
+                name=f"`{self.prefix}aistats`",
+                value="**Descrição:** Métricas da IA por provedor e rota (modelo leve/completo)\n"
+                      "**Mostra:** Chamadas, falhas por cota, latência p50/p90, tokens, circuitos\n"
+                      "**Exemplo:** `!aistats`",
+                inline=False
+            )
             embed.add_field(
                 name=f"`{self.prefix}history [filtro]`",
                 value="**Descrição:** Histórico de interações (últimas 10)\n"
@@ -2099,9 +4726,9 @@ class HelpView(discord.ui.View):
             )
             embed.add_field(
                 name=f"`{self.prefix}resetconfig`",
-                value="**Descrição:** Restaura configurações padrão\n"
+                value="**Descrição:** Restaura as configurações padrão deste servidor\n"
                       "**Exemplo:** `!resetconfig`\n"
-                      "**Permissão:** Administrador\n"
+                      "**Permissão:** Administrador (em DM, só o dono do bot, para as globais)\n"
                       "**Atenção:** Não apaga memórias ou histórico",
                 inline=False
             )
@@ -2313,7 +4940,7 @@ async def help_command(ctx):
 async def respondall(ctx, status: str = None):
     """Ativa ou desativa participação inteligente em todos os canais"""
     if status is None:
-        current = get_bot_config("respond_all_channels", "false")
+        current = get_guild_config(ctx.guild, "respond_all_channels", "false")
         status_text = "ativada ✅" if current == "true" else "desativada ❌"
         await ctx.send(f"🤖 **Participação em Todos os Canais**\n\n"
                       f"Status atual: **{status_text}**\n\n"
@@ -2325,7 +4952,7 @@ async def respondall(ctx, status: str = None):
     status = status.lower()
 
     if status in ["on", "ativar", "ligar", "sim", "yes"]:
-        set_bot_config("respond_all_channels", "true")
+        set_guild_config(ctx.guild, "respond_all_channels", "true")
         await ctx.send("✅ **Participação em todos os canais ATIVADA!**\n\n"
                       "O bot agora participará inteligentemente de conversas quando:\n"
                       "• Detectar tópicos de interesse (livros, filosofia, gatos, etc)\n"
@@ -2334,7 +4961,7 @@ async def respondall(ctx, status: str = None):
                       "**Dica:** Use `!blockchannel #canal` para bloquear canais específicos.")
 
     elif status in ["off", "desativar", "desligar", "nao", "não", "no"]:
-        set_bot_config("respond_all_channels", "false")
+        set_guild_config(ctx.guild, "respond_all_channels", "false")
         await ctx.send("✅ **Participação em todos os canais DESATIVADA!**\n\n"
                       "O bot agora apenas responderá:\n"
                       "• Quando for mencionado diretamente\n"
@@ -2353,11 +4980,11 @@ async def blockchannel_cmd(ctx, channel: discord.TextChannel = None):
     """Bloqueia um canal para o bot não responder"""
     if channel is None:
         await ctx.send("❌ Você precisa especificar um canal!\n"
-                      f"**Exemplo:** `{get_bot_config('prefix', '!')}blockchannel #off-topic`")
+                      f"**Exemplo:** `{get_guild_config(ctx.guild, 'prefix', '!')}blockchannel #off-topic`")
         return
 
-    server_id = str(ctx.guild.id) if ctx.guild else "DM"
-    block_channel(str(channel.id), server_id)
+    # Indexado pelo servidor do próprio canal, que é onde on_message vai procurá-lo
+    block_channel(str(channel.id), str(channel.guild.id))
 
     await ctx.send(f"🚫 Canal {channel.mention} **bloqueado**!\n\n"
                   "O bot não responderá a mensagens neste canal, mesmo se for mencionado.")
@@ -2368,7 +4995,7 @@ async def unblockchannel_cmd(ctx, channel: discord.TextChannel = None):
     """Desbloqueia um canal"""
     if channel is None:
         await ctx.send("❌ Você precisa especificar um canal!\n"
-                      f"**Exemplo:** `{get_bot_config('prefix', '!')}unblockchannel #off-topic`")
+                      f"**Exemplo:** `{get_guild_config(ctx.guild, 'prefix', '!')}unblockchannel #off-topic`")
         return
 
     if unblock_channel(str(channel.id)):
@@ -2431,7 +5058,7 @@ async def setprefix(ctx, new_prefix: str):
         await ctx.send("❌ Prefixo muito longo! Use no máximo 5 caracteres.")
         return
 
-    set_bot_config("prefix", new_prefix)
+    set_guild_config(ctx.guild, "prefix", new_prefix)
     await ctx.send(f"✅ Prefixo alterado para: `{new_prefix}`")
 
 @bot.command(name="setpersonality")
@@ -2451,7 +5078,7 @@ async def settone(ctx, tone: str):
         await ctx.send(f"❌ Tom inválido! Opções: {', '.join(valid_tones)}")
         return
 
-    set_bot_config("tone", tone)
+    set_guild_config(ctx.guild, "tone", tone)
     await ctx.send(f"✅ Tom de conversa definido como: **{tone}**")
 
 @bot.command(name="setmood")
@@ -2464,7 +5091,7 @@ async def setmood(ctx, mood: str):
         await ctx.send(f"❌ Humor inválido! Opções: {', '.join(valid_moods)}")
         return
 
-    set_bot_config("current_mood", mood)
+    set_guild_config(ctx.guild, "current_mood", mood)
     await ctx.send(f"✅ Humor atual definido como: **{mood}**")
 
 @bot.command(name="setstatus")
@@ -2608,19 +5235,19 @@ async def autorotate(ctx, status: str = None):
 @commands.has_permissions(administrator=True)
 async def setchannel(ctx, channel: discord.TextChannel = None):
     """Define ou remove o canal padrão de interação"""
-    current_channel_id = get_bot_config("default_channel")
+    current_channel_id = get_guild_config(ctx.guild, "default_channel")
 
     if channel is None or (current_channel_id and str(channel.id) == current_channel_id):
         # Se nenhum canal for especificado ou o canal atual for o mesmo, remove a configuração
         if current_channel_id:
-            set_bot_config("default_channel", "")
+            set_guild_config(ctx.guild, "default_channel", "")
             await ctx.send(f"✅ Canal padrão removido. O bot não responderá automaticamente a mensagens em canais específicos até um novo canal ser configurado.")
         else:
             await ctx.send("❌ Nenhum canal padrão está configurado para remover.")
         return
 
     # Caso contrário, define o novo canal
-    set_bot_config("default_channel", str(channel.id))
+    set_guild_config(ctx.guild, "default_channel", str(channel.id))
     await ctx.send(f"✅ Canal padrão definido: {channel.mention}. O bot responderá a quase todas as mensagens neste canal.")
 
 @bot.command(name="setname")
@@ -2654,9 +5281,9 @@ async def config(ctx):
     )
 
     configs = {
-        "Prefixo": get_bot_config("prefix", "!"),
-        "Tom": get_bot_config("tone", "neutro"),
-        "Humor": get_bot_config("current_mood", "neutro"),
+        "Prefixo": get_guild_config(ctx.guild, "prefix", "!"),
+        "Tom": get_guild_config(ctx.guild, "tone", "neutro"),
+        "Humor": get_guild_config(ctx.guild, "current_mood", "neutro"),
         "Nome": get_bot_config("bot_name", "Akutagawa"),
         "Duração da Memória": get_bot_config("memory_duration", "longo"),
         "Aprendizado Contínuo": get_bot_config("continuous_learning", "true")
@@ -2665,7 +5292,7 @@ async def config(ctx):
     for key, value in configs.items():
         embed.add_field(name=key, value=value, inline=True)
 
-    channel_id = get_bot_config("default_channel")
+    channel_id = get_guild_config(ctx.guild, "default_channel")
     if channel_id:
         channel = bot.get_channel(int(channel_id))
         embed.add_field(name="Canal Padrão", value=channel.mention if channel else "Não encontrado", inline=True)
@@ -2676,7 +5303,7 @@ async def config(ctx):
 async def remember(ctx, *, args: str):
     """Adiciona ou atualiza uma memória"""
     if "|" not in args:
-        await ctx.send(f"❌ Formato incorreto! Use: `{get_bot_config('prefix', '!')}remember chave | valor`")
+        await ctx.send(f"❌ Formato incorreto! Use: `{get_guild_config(ctx.guild, 'prefix', '!')}remember chave | valor`")
         return
 
     key, value = args.split("|", 1)
@@ -2786,16 +5413,12 @@ async def setrelationship(ctx, member: discord.Member, level: int):
         await ctx.send("❌ Nível deve estar entre 0 e 10!")
         return
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
+    db.execute("""
         INSERT INTO relationships (user_id, level) 
         VALUES (?, ?)
         ON CONFLICT(user_id) 
         DO UPDATE SET level = excluded.level
     """, (str(member.id), level))
-    conn.commit()
-    conn.close()
 
     await ctx.send(f"✅ Nível de relacionamento com {member.mention} definido para: **{level}/10**")
 
@@ -2836,28 +5459,71 @@ async def stats(ctx):
     embed.add_field(name="Mensagens Hoje", value=str(stats_data["messages_today"]), inline=True)
     embed.add_field(name="Total de Interações", value=str(stats_data["total_interactions"]), inline=True)
     embed.add_field(name="Servidores", value=str(len(bot.guilds)), inline=True)
-    embed.add_field(name="Humor Atual", value=get_bot_config("current_mood", "neutro"), inline=True)
+    embed.add_field(name="Humor Atual", value=get_guild_config(ctx.guild, "current_mood", "neutro"), inline=True)
+
+    queue_stats = "\n".join(
+        f"{policy['name']}: {ai_scheduler.granted[priority]} ✅ / {ai_scheduler.dropped[priority]} ⏳"
+        for priority, policy in AI_PRIORITY_POLICY.items()
+    )
+    embed.add_field(name="Fila de IA (atendidas/descartadas)", value=queue_stats, inline=False)
+    embed.add_field(name="Respostas Locais", value=str(sum(local_responder.hits.values())), inline=True)
+    embed.add_field(name="Cache de Respostas", value=f"{response_cache.hits} acertos / {response_cache.misses} faltas", inline=True)
+    embed.add_field(
+        name="Entregas",
+        value=f"{channel_outbox.delivered} enviadas / {channel_outbox.failed} falhas / {channel_outbox.throttled} seguradas pelo limite do canal",
+        inline=False
+    )
+
+    await ctx.send(embed=embed)
+
+@bot.command(name="aistats")
+async def aistats(ctx):
+    """Exibe métricas da IA por provedor e rota de modelo"""
+    embed = discord.Embed(
+        title="🧠 Métricas da IA",
+        description=f"Roteamento por complexidade: {'ativo' if AI_MODEL_ROUTING else 'desativado'}",
+        color=discord.Color.blue()
+    )
+
+    if not ai_route_metrics.routes:
+        embed.add_field(name="Rotas", value="Nenhuma chamada registrada ainda.", inline=False)
+
+    for (provider_name, route), entry in sorted(ai_route_metrics.routes.items()):
+        latencies = entry["latencies"]
+        embed.add_field(
+            name=f"{provider_name} / {route} ({entry['model']})",
+            value=f"Chamadas: {entry['calls']} ({entry['failures']} falhas, {entry['rate_limited']} por cota)\n"
+                  f"Latência p50/p90: {ai_route_metrics.percentile(latencies, 0.5):.2f}s / {ai_route_metrics.percentile(latencies, 0.9):.2f}s\n"
+                  f"Tokens: {entry['tokens']}",
+            inline=False
+        )
+
+    embed.add_field(
+        name="Prazo e Hedging",
+        value=f"Prazo por chamada: {AI_REQUEST_TIMEOUT:.0f}s\n"
+              f"Hedging: {'ativo' if request_hedger.enabled else 'desativado'} "
+              f"({request_hedger.hedged} reservas, {request_hedger.hedge_wins} venceram, limite {AI_HEDGE_BUDGET_PERCENT:.0f}%)",
+        inline=False
+    )
+
+    circuits = "\n".join(f"{provider.name}: {breaker.state}" for provider, breaker in ai_providers.entries)
+    if circuits:
+        embed.add_field(name="Circuitos", value=circuits, inline=False)
 
     await ctx.send(embed=embed)
 
 @bot.command(name="history")
 async def history(ctx, target: Optional[str] = None):
     """Mostra histórico de interações"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
     if target:
         # Filtra por canal ou usuário
         if target.startswith("<#"):
             channel_id = target.strip("<#>")
-            cursor.execute("SELECT * FROM interaction_history WHERE channel_id = ? ORDER BY timestamp DESC LIMIT 10", (channel_id,))
+            history = db.fetchall("SELECT * FROM interaction_history WHERE channel_id = ? ORDER BY timestamp DESC LIMIT 10", (channel_id,))
         else:
-            cursor.execute("SELECT * FROM interaction_history WHERE user_id LIKE ? ORDER BY timestamp DESC LIMIT 10", (f"%{target}%",))
+            history = db.fetchall("SELECT * FROM interaction_history WHERE user_id LIKE ? ORDER BY timestamp DESC LIMIT 10", (f"%{target}%",))
     else:
-        cursor.execute("SELECT * FROM interaction_history ORDER BY timestamp DESC LIMIT 10")
-
-    history = cursor.fetchall()
-    conn.close()
+        history = db.fetchall("SELECT * FROM interaction_history ORDER BY timestamp DESC LIMIT 10")
 
     if not history:
         await ctx.send("📭 Nenhum histórico encontrado.")
@@ -2882,11 +5548,7 @@ async def history(ctx, target: Optional[str] = None):
 @bot.command(name="activity")
 async def activity(ctx):
     """Mostra atividade recente do bot"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT date, messages_sent FROM stats ORDER BY date DESC LIMIT 7")
-    activity = cursor.fetchall()
-    conn.close()
+    activity = db.fetchall("SELECT date, messages_sent FROM stats ORDER BY date DESC LIMIT 7")
 
     if not activity:
         await ctx.send("📭 Nenhuma atividade registrada.")
@@ -2905,12 +5567,7 @@ async def activity(ctx):
 @bot.command(name="clearmemories")
 async def clearmemories(ctx):
     """Apaga TODAS as memórias do usuário"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM facts WHERE user_id = ?", (str(ctx.author.id),))
-    deleted_count = cursor.rowcount
-    conn.commit()
-    conn.close()
+    deleted_count = delete_user_facts(str(ctx.author.id))
 
     if deleted_count > 0:
         await ctx.send(f"🗑️ **{deleted_count}** memória(s) apagada(s) com sucesso!")
@@ -2926,15 +5583,10 @@ async def userstats(ctx, member: discord.Member = None):
     level, interactions = get_relationship(str(target.id))
     facts = get_user_facts(str(target.id))
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT last_interaction FROM relationships WHERE user_id = ?", (str(target.id),))
-    result = cursor.fetchone()
+    result = db.fetchone("SELECT last_interaction FROM relationships WHERE user_id = ?", (str(target.id),))
     last_interaction = result[0] if result else "Nunca"
 
-    cursor.execute("SELECT COUNT(*) FROM interaction_history WHERE user_id = ?", (str(target.id),))
-    total_messages = cursor.fetchone()[0]
-    conn.close()
+    total_messages = db.fetchone("SELECT COUNT(*) FROM interaction_history WHERE user_id = ?", (str(target.id),))[0]
 
     level_names = {
         0: "Desconhecido",
@@ -2971,15 +5623,10 @@ async def profile(ctx):
     level, interactions = get_relationship(str(ctx.author.id))
     facts = get_user_facts(str(ctx.author.id))
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT last_interaction FROM relationships WHERE user_id = ?", (str(ctx.author.id),))
-    result = cursor.fetchone()
+    result = db.fetchone("SELECT last_interaction FROM relationships WHERE user_id = ?", (str(ctx.author.id),))
     last_interaction = result[0] if result else "Primeira vez aqui!"
 
-    cursor.execute("SELECT COUNT(*) FROM interaction_history WHERE user_id = ?", (str(ctx.author.id),))
-    total_messages = cursor.fetchone()[0]
-    conn.close()
+    total_messages = db.fetchone("SELECT COUNT(*) FROM interaction_history WHERE user_id = ?", (str(ctx.author.id),))[0]
 
     level_names = {
         0: "Desconhecido",
@@ -3038,13 +5685,11 @@ async def serverinfo(ctx):
     embed.add_field(name="📅 Criado em", value=guild.created_at.strftime("%d/%m/%Y"), inline=True)
 
     # Configurações do bot neste servidor
-    default_channel_id = get_bot_config("default_channel")
-    if default_channel_id:
-        channel = bot.get_channel(int(default_channel_id))
-        if channel and channel.guild == guild:
-            embed.add_field(name="📍 Canal Padrão", value=channel.mention, inline=True)
+    channel = get_guild_default_channel(guild)
+    if channel:
+        embed.add_field(name="📍 Canal Padrão", value=channel.mention, inline=True)
 
-    embed.add_field(name="⚙️ Prefixo", value=get_bot_config("prefix", "!"), inline=True)
+    embed.add_field(name="⚙️ Prefixo", value=get_guild_config(guild, "prefix", "!"), inline=True)
 
     if guild.icon:
         embed.set_thumbnail(url=guild.icon.url)
@@ -3054,31 +5699,25 @@ async def serverinfo(ctx):
     await ctx.send(embed=embed)
 
 @bot.command(name="resetconfig")
-@commands.has_permissions(administrator=True)
+@commands.check_any(commands.has_permissions(administrator=True), commands.is_owner())
 async def resetconfig(ctx):
-    """Restaura configurações padrão"""
-    default_configs = {
-        "prefix": "!",
-        "tone": "neutro",
-        "default_channel": "",
-        "avatar_url": "",
-        "bot_name": "Akutagawa",
-        "memory_duration": "longo",
-        "continuous_learning": "true",
-        "current_mood": "neutro"
-    }
-
-    for key, value in default_configs.items():
-        set_bot_config(key, value)
+    """Restaura configurações padrão do servidor (em DM, as globais; só o dono do bot)"""
+    if ctx.guild:
+        # Grava os padrões no escopo deste servidor: não herda valores globais antigos
+        # e não mexe nas configurações globais nem nos outros servidores
+        set_guild_configs(ctx.guild, {key: DEFAULT_BOT_CONFIG[key] for key in GUILD_CONFIG_KEYS})
+        await ctx.send("✅ Configurações deste servidor restauradas para o padrão!\n\n**Nota:** Memórias e histórico foram preservados.")
+        return
 
-    await ctx.send("✅ Configurações restauradas para o padrão!\n\n**Nota:** Memórias e histórico foram preservados.")
+    set_bot_configs(DEFAULT_BOT_CONFIG)
+    await ctx.send("✅ Configurações globais restauradas para o padrão!\n\n**Nota:** Memórias e histórico foram preservados.")
 
 @bot.command(name="clearcontext")
 async def clearcontext(ctx):
     """Limpa o contexto da conversa atual"""
     channel_id = str(ctx.channel.id)
-    if channel_id in conversation_context:
-        del conversation_context[channel_id]
+    await conversation_store.load(channel_id)
+    if conversation_store.clear(channel_id):
         await ctx.send("🗑️ Contexto da conversa limpo! O bot esqueceu as últimas mensagens desta conversa.")
     else:
         await ctx.send("📭 Não há contexto de conversa para limpar neste canal.")
@@ -3087,17 +5726,22 @@ async def clearcontext(ctx):
 async def viewcontext(ctx):
     """Mostra o contexto atual da conversa"""
     channel_id = str(ctx.channel.id)
+    await conversation_store.load(channel_id)
     context = get_conversation_context(channel_id)
 
-    if not context:
-        await ctx.send("📭 Não há contexto de conversa armazenado neste canal.")
-        return
-
+    # Mesmo sem contexto neste canal, o rodapé mostra o uso de memória do bot
     embed = discord.Embed(
         title="🧠 Contexto da Conversa Atual",
-        description=context[:4000],  # Discord limita a 4096 caracteres
+        description=context[:4000] if context else "📭 Não há contexto de conversa armazenado neste canal.",  # Discord limita a 4096 caracteres
         color=discord.Color.blue()
     )
+    memory = conversation_store.stats()
+    embed.set_footer(
+        text=f"Memória: {memory['channels']} canais, {memory['exchanges']} trocas, "
+             f"{memory['bytes'] / 1024:.1f} KB de {CONTEXT_MAX_BYTES / 1024:.0f} KB | "
+             f"descartados: {memory['evicted_idle']} por inatividade, {memory['evicted_capacity']} por limite | "
+             f"recarregados do banco: {memory['rehydrated']}"
+    )
     await ctx.send(embed=embed)
 
 # ========== Tratamento de Erros ==========
@@ -3119,6 +5763,11 @@ async def admin_error(ctx, error):
 
 # ========== Inicia o Bot ==========
 if __name__ == "__main__":
+    if "--bench-split" in sys.argv:
+        exit(0 if run_split_benchmark() else 1)
+    if "--check-facts" in sys.argv:
+        exit(0 if run_fact_check() else 1)
+
     if not TOKEN:
         print("❌ ERRO: DISCORD_BOT_TOKEN não configurado!")
         print("Configure a variável de ambiente DISCORD_BOT_TOKEN no Replit Secrets")